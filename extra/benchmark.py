@@ -0,0 +1,909 @@
+#!/usr/bin/env python
+# encoding: utf-8
+#
+# Copyright (c) 2026 deanishe@deanishe.net
+#
+# MIT Licence. See http://opensource.org/licenses/MIT
+#
+# Created on 2026-10-19
+#
+
+"""benchmark.py <command> [options]
+
+Time MailTo's hot paths against a set of synthetic caches.
+
+The workflow is run in a temporary cache and data directory, so this
+works on any machine with Python 2.7, not just on a Mac.
+
+Commands:
+    search      Time `mailto.py search` runs. With --phases, also show
+                how long each phase took, from the workflow's metrics.
+    syscalls    Count the filesystem calls made by one `mailto.py search`.
+                Uses `strace` if it's installed, otherwise wraps the
+                `os` functions in the Python process.
+    imports     Report the modules imported by `mailto.py search` and
+                how long they take to import (like Python 3's
+                `-X importtime`), and the number of `Workflow` objects
+                it creates.
+    compose     Time `mailto.py compose` and `compose-batch`. URLs are
+                captured to a file instead of being opened. Also time
+                formatting large groups with and without the cache of
+                MIME-encoded names.
+    json        Time `verbose_json` against plain `json` and the old
+                line-based parser on a large, commented client rules
+                file and check they agree. Also compare the comment
+                stripper to a simple reference version on random text
+                and fail if they disagree.
+    logging     Time `search` and `compose-batch` with debug logging
+                off and on, and report the size of the log file.
+    serializers Time loading and saving the contacts and client caches
+                with each registered serializer, and compare file sizes.
+    locks       Time `LockFile` under contention: many processes
+                repeatedly lock one file, hold it briefly, and release
+                it. Some of them may take shared (reader) locks.
+    background  Check that many processes asking for the same background
+                job at once start it only once, both via
+                `run_in_background` and via `cached_data_swr`.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from time import sleep, time
+
+SRCDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+SRCDIR = os.path.normpath(SRCDIR)
+
+BUNDLE_ID = 'net.deanishe.alfred-mailto'
+
+# Prepended to `mailto.py` by `syscalls` when `strace` isn't available.
+# Counts calls to the `os` functions that hit the filesystem and prints
+# the counts to stderr when the process exits.
+TRACE_SHIM = r'''
+import __builtin__, atexit, json, os, sys
+counts = {}
+def wrap(mod, name, key=None):
+    func = getattr(mod, name)
+    def wrapper(*args, **kwargs):
+        counts[key or name] = counts.get(key or name, 0) + 1
+        return func(*args, **kwargs)
+    setattr(mod, name, wrapper)
+for name in ('stat', 'lstat', 'listdir', 'unlink', 'rename', 'mkdir',
+             'makedirs', 'readlink', 'access'):
+    wrap(os, name)
+wrap(__builtin__, 'open')
+atexit.register(lambda: sys.stderr.write(
+    '\nSYSCALLS ' + json.dumps(counts) + '\n'))
+sys.argv = sys.argv[1:]
+__file__ = sys.argv[0]
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+execfile(__file__)
+'''
+
+# Prepended to `mailto.py` by `imports`. Times every import of a new
+# module and counts `Workflow` objects, then prints the results to
+# stderr when the process exits.
+IMPORT_SHIM = r'''
+import __builtin__, atexit, json, os, sys
+from time import time
+_import = __builtin__.__import__
+imports = {}
+stack = []
+workflows = [0]
+def patch():
+    mod = sys.modules.get('workflow.workflow')
+    cls = getattr(mod, 'Workflow', None)
+    if cls is None or hasattr(cls, '_counted'):
+        return
+    init = cls.__init__
+    def counting_init(self, *args, **kwargs):
+        workflows[0] += 1
+        init(self, *args, **kwargs)
+    cls.__init__ = counting_init
+    cls._counted = True
+def timed_import(name, *args, **kwargs):
+    new = name not in sys.modules
+    stack.append(0.0)
+    start = time()
+    try:
+        return _import(name, *args, **kwargs)
+    finally:
+        elapsed = time() - start
+        children = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        if new and name in sys.modules:
+            imports[name] = (elapsed * 1000, (elapsed - children) * 1000)
+            patch()
+__builtin__.__import__ = timed_import
+atexit.register(lambda: sys.stderr.write('\nIMPORTS ' + json.dumps(
+    {'imports': imports, 'workflows': workflows[0]}) + '\n'))
+sys.argv = sys.argv[1:]
+__file__ = sys.argv[0]
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+execfile(__file__)
+'''
+
+# Run by `locks` in each worker process. Prints how long each
+# acquisition waited and how often an exclusive lock was held while
+# another process held the lock (which should be never).
+LOCK_WORKER = r'''
+import json, os, sys, time
+path, iterations, hold, shared = sys.argv[1:]
+sys.path.insert(0, %r)
+from workflow.util import LockFile
+waits = []
+overlaps = 0
+for _ in range(int(iterations)):
+    lock = LockFile(path, timeout=60, shared=shared == '1')
+    start = time.time()
+    lock.acquire()
+    waits.append(time.time() - start)
+    if shared != '1':
+        try:
+            os.mkdir(path + '.held')
+        except OSError:
+            overlaps += 1
+    time.sleep(float(hold))
+    if shared != '1':
+        try:
+            os.rmdir(path + '.held')
+        except OSError:
+            pass
+    lock.release()
+print(json.dumps({'waits': waits, 'overlaps': overlaps}))
+''' % SRCDIR
+
+# Run by `background` in each worker process. Waits until the given
+# time, so the workers start together, then asks for the job with
+# `run_in_background` ("job") or `cached_data_swr` ("swr"). Prints the
+# number of jobs the worker started.
+BACKGROUND_WORKER = r'''
+import json, sys, time
+mode, name, start, cmd = sys.argv[1:]
+sys.path.insert(0, %r)
+from workflow import Workflow3, background
+wf = Workflow3()
+launches = []
+run_in_background = background.run_in_background
+def counted(*args, **kwargs):
+    retcode = run_in_background(*args, **kwargs)
+    if retcode == 0:
+        launches.append(retcode)
+    return retcode
+background.run_in_background = counted
+time.sleep(max(float(start) - time.time(), 0))
+if mode == 'job':
+    counted(name, json.loads(cmd))
+else:
+    wf.cached_data_swr(name, json.loads(cmd), max_age=60)
+print(len(launches))
+''' % SRCDIR
+
+# The job started by `background`. Records that it ran, then takes a
+# while to "regenerate" the cache, so the other workers ask for it
+# while it's running.
+BACKGROUND_JOB = r'''
+import sys, time
+path, name, duration = sys.argv[1:]
+sys.path.insert(0, %r)
+from workflow import Workflow3
+with open(path, 'a') as fp:
+    fp.write(name + '\n')
+time.sleep(float(duration))
+Workflow3().cache_data(name, {'regenerated': time.time()})
+''' % SRCDIR
+
+
+class Environment(object):
+    """Temporary workflow directories populated with synthetic caches."""
+
+    def __init__(self, contacts=1000):
+        self.count = contacts
+        self.root = tempfile.mkdtemp(prefix='mailto-bench-')
+        self.env = dict(os.environ)
+        self.env.update({
+            'alfred_workflow_bundleid': BUNDLE_ID,
+            'alfred_workflow_cache': os.path.join(self.root, 'cache'),
+            'alfred_workflow_data': os.path.join(self.root, 'data'),
+            'alfred_workflow_name': 'MailTo',
+            'alfred_workflow_version': '2.3.1',
+            'alfred_version': '3.8',
+            'MAILTO_DISPATCHER': 'capture',
+            'MAILTO_CAPTURE_FILE': os.path.join(self.root, 'urls.txt'),
+        })
+        self.env.pop('alfred_debug', None)
+
+    def __enter__(self):
+        self.populate()
+        return self
+
+    def __exit__(self, *exc_info):
+        shutil.rmtree(self.root)
+
+    def populate(self):
+        """Create caches and settings in a fresh Python process."""
+        self.call('_populate', self.count)
+
+    def call(self, name, *args):
+        """Call function ``name`` of this module in a fresh process."""
+        code = 'import sys, json; sys.path.insert(0, {!r}); ' \
+            'import benchmark; benchmark.{}(*json.loads({!r}))'.format(
+                os.path.dirname(os.path.abspath(__file__)), name,
+                json.dumps(args))
+        self.check_call([sys.executable, '-c', code])
+
+    def check_call(self, cmd, **kwargs):
+        return subprocess.check_call(cmd, env=self.env, cwd=SRCDIR,
+                                     **kwargs)
+
+    def run(self, args, stdin=None, **kwargs):
+        """Run `mailto.py` with ``args`` and return (duration, stderr).
+
+        ``stdin`` is a string to pass to the process on STDIN.
+
+        """
+        cmd = [sys.executable, 'mailto.py'] + args
+        start = time()
+        p = subprocess.Popen(cmd, env=self.env, cwd=SRCDIR,
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, **kwargs)
+        _, stderr = p.communicate(stdin)
+        duration = time() - start
+        if p.returncode:
+            raise RuntimeError('mailto.py {} failed: {}'.format(
+                               ' '.join(args), stderr))
+        return duration, stderr
+
+
+def make_contacts(count):
+    """Return ``count`` synthetic people and a few groups, and names."""
+    contacts = []
+    names = {}
+    for i in range(count):
+        name = 'Person{0} Surname{1}'.format(i, i % 97)
+        email = 'person{0}@example{1}.com'.format(i, i % 13)
+        names[email] = (name, 0)
+        contacts.append({
+            'name': name,
+            'email': email,
+            'nickname': '',
+            'company': False,
+            'is_group': False,
+            'is_company': False,
+            'key': ' {0} {1}'.format(name, email),
+        })
+
+    for i in range(max(count // 100, 1)):
+        contacts.append({
+            'name': 'Group {0}'.format(i),
+            'members': list(range(i, count, 50)),
+            'is_group': True,
+            'is_company': False,
+            'key': 'Group {0}'.format(i),
+        })
+
+    return contacts, names
+
+
+def _populate(count):
+    """Write synthetic caches. Called in a subprocess by `Environment`."""
+    os.chdir(SRCDIR)
+    sys.path.insert(0, SRCDIR)
+    from workflow import Workflow3
+    from client import SNAPSHOT_VERSION, compile_client_rules
+    from contacts import CONTACTS_VERSION, contacts_serializer
+    from nameindex import write_index
+    from store import GenerationStore
+    from watcher import apps_source, contacts_source
+
+    wf = Workflow3()
+    contacts, names = make_contacts(count)
+    GenerationStore(wf, 'contacts').publish(
+        {'contacts': contacts}, serializer=contacts_serializer(),
+        writers={'names.idx': lambda path: write_index(path, names)},
+        version=CONTACTS_VERSION, fingerprint=contacts_source().fingerprint())
+    mail = {'name': 'Mail', 'path': '/Applications/Mail.app',
+            'bundleid': 'com.apple.mail'}
+    open(wf.datafile('did_run-v2'), 'wb').close()
+    shutil.copy(wf.workflowfile('client_rules.json.template'),
+                wf.datafile('client_rules.json'))
+    GenerationStore(wf, 'client_snapshot').publish(
+        {'snapshot': {'apps': [mail],
+                      'system_default_app': mail,
+                      'client_rules': compile_client_rules(wf)}},
+        version=SNAPSHOT_VERSION,
+        fingerprint=apps_source().fingerprint())
+    wf.cache_data('__workflow_update_status', {'available': False})
+
+
+def _time_serializers(count, runs):
+    """Time serializers. Called in a subprocess by `cmd_serializers`."""
+    os.chdir(SRCDIR)
+    sys.path.insert(0, SRCDIR)
+    from workflow import Workflow3, manager
+    from client import compile_client_rules
+
+    wf = Workflow3()
+    mail = {'name': 'Mail', 'path': '/Applications/Mail.app',
+            'bundleid': 'com.apple.mail'}
+    caches = [
+        ('contacts', make_contacts(count)[0]),
+        ('client', {'apps': [mail], 'system_default_app': mail,
+                    'client_rules': compile_client_rules(wf)}),
+    ]
+    path = wf.cachefile('serializer-test')
+    print('{0:<10s} {1:<10s} {2:>10s} {3:>10s} {4:>10s}'.format(
+          'cache', 'serializer', 'dump ms', 'load ms', 'size KB'))
+    for label, data in caches:
+        for name in manager.serializers:
+            serializer = manager.serializer(name)
+            dumps = []
+            loads = []
+            try:
+                for _ in range(runs):
+                    start = time()
+                    with open(path, 'wb') as fp:
+                        serializer.dump(data, fp)
+                    dumps.append(time() - start)
+                    start = time()
+                    with open(path, 'rb') as fp:
+                        serializer.load(fp)
+                    loads.append(time() - start)
+            except (TypeError, ValueError) as err:
+                print('{0:<10s} {1:<10s} unsupported: {2}'.format(
+                      label, name, err))
+                continue
+
+            print('{0:<10s} {1:<10s} {2:10.2f} {3:10.2f} {4:10.1f}'.format(
+                  label, name, min(dumps) * 1000, min(loads) * 1000,
+                  os.path.getsize(path) / 1024.0))
+
+
+def _time_formatter(sizes, runs):
+    """Time `Formatter.get_url`. Called in a subprocess by `cmd_compose`."""
+    os.chdir(SRCDIR)
+    sys.path.insert(0, SRCDIR)
+    from workflow import Workflow3
+    from client import Formatter, cached_client_rules
+
+    wf = Workflow3()
+    rules = cached_client_rules(wf)
+    print('Formatter.get_url with N recipients:')
+    for size in sizes:
+        for kind, template in (('ASCII', u'Person{0} Surname'),
+                               ('non-ASCII', u'P\xe9rson{0} S\xfcrname')):
+            recipients = [(template.format(i),
+                           u'person{0}@example.com'.format(i))
+                          for i in range(size)]
+            formatter = Formatter(None, wf, rules)
+            for label, clear in (('uncached', True), ('cached', False)):
+                timings = []
+                for _ in range(runs):
+                    if clear:
+                        formatter._encoded_names.clear()
+                    start = time()
+                    formatter.get_url(recipients, True)
+                    timings.append(time() - start)
+                report('{0} {1} {2}'.format(size, kind, label), timings)
+
+
+def report(label, timings):
+    """Print summary of ``timings`` (seconds)."""
+    timings = sorted(timings)
+    n = len(timings)
+    print('{0:<24s} n={1:<4d} min={2:7.1f}ms  median={3:7.1f}ms  '
+          'mean={4:7.1f}ms'.format(label, n, timings[0] * 1000,
+                                   timings[n // 2] * 1000,
+                                   sum(timings) / n * 1000))
+
+
+def cmd_search(args):
+    with Environment(args.contacts) as env:
+        env.run(['search', args.query])  # warm up OS caches
+        if args.phases:
+            env.env['WORKFLOW_METRICS'] = '1'
+        timings = [env.run(['search', args.query])[0]
+                   for _ in range(args.runs)]
+        report('search {!r}'.format(args.query), timings)
+        if args.phases:
+            path = os.path.join(env.root, 'cache',
+                                BUNDLE_ID + '.metrics.jsonl')
+            with open(path) as fp:
+                runs = [json.loads(line) for line in fp]
+            report_phases(runs)
+
+
+def report_phases(runs):
+    """Print median time of each phase in metrics ``runs``."""
+    phases = {'(startup)': [r['startup'] for r in runs],
+              '(run total)': [r['total'] for r in runs]}
+    for r in runs:
+        for name, ms in r['spans'].items():
+            phases.setdefault(name, []).append(ms)
+
+    def median(times):
+        return sorted(times)[len(times) // 2]
+
+    for name in sorted(phases, key=lambda n: -median(phases[n])):
+        print('  {0:<22s} median={1:7.2f}ms  max={2:7.2f}ms'.format(
+              name, median(phases[name]), max(phases[name])))
+
+
+def make_recipient_lists(count, contacts):
+    """Return ``count`` lines of recipients for `compose-batch`."""
+    lines = []
+    for i in range(count):
+        emails = ['person{0}@example{1}.com'.format(j, j % 13)
+                  for j in range(i, i + 1 + i % 5)
+                  if j < contacts]
+        if i % 2:
+            lines.append(json.dumps(emails + ['unknown{0}@example.com'
+                                              .format(i)]))
+        else:
+            lines.append(', '.join(emails))
+    return '\n'.join(lines) + '\n'
+
+
+def cmd_compose(args):
+    with Environment(args.contacts) as env:
+        recipients = 'person1@example1.com, person2@example2.com'
+        env.run(['compose', recipients])
+        timings = [env.run(['compose', recipients])[0]
+                   for _ in range(args.runs)]
+        report('compose', timings)
+
+        stdin = make_recipient_lists(args.lists, args.contacts)
+        for extra in ([], ['--open']):
+            timings = [env.run(['compose-batch'] + extra, stdin)[0]
+                       for _ in range(args.runs)]
+            report(' '.join(['compose-batch'] + extra), timings)
+            median = sorted(timings)[len(timings) // 2]
+            print('  {0} lists, {1:.0f} URLs/s'.format(args.lists,
+                                                       args.lists / median))
+
+        env.call('_time_formatter', [500, 2000], args.runs)
+
+
+def cmd_serializers(args):
+    with Environment(args.contacts) as env:
+        env.call('_time_serializers', args.contacts, args.runs)
+
+
+def cmd_logging(args):
+    with Environment(args.contacts) as env:
+        stdin = make_recipient_lists(args.lists, args.contacts)
+        logfile = os.path.join(env.root, 'cache', BUNDLE_ID + '.log')
+        env.run(['search', args.query])  # warm up OS caches
+        for debug in (False, True):
+            if debug:
+                env.env['alfred_debug'] = '1'
+            size = os.path.getsize(logfile)
+            label = ' (debug)' if debug else ''
+            timings = [env.run(['search', args.query])[0]
+                       for _ in range(args.runs)]
+            report('search' + label, timings)
+            timings = [env.run(['compose-batch'], stdin)[0]
+                       for _ in range(args.runs)]
+            report('compose-batch' + label, timings)
+            print('  {0:.1f}KB logged per run'.format(
+                  (os.path.getsize(logfile) - size) / 1024.0 /
+                  (args.runs * 2)))
+
+
+def _count_strace(env, args):
+    """Return syscall counts from ``strace``."""
+    out = os.path.join(env.root, 'strace.txt')
+    env.check_call(['strace', '-f', '-qq', '-e', 'trace=file', '-o', out,
+                    sys.executable, 'mailto.py'] + args,
+                   stdout=open(os.devnull, 'wb'),
+                   stderr=open(os.devnull, 'wb'))
+    counts = {}
+    with open(out) as fp:
+        for line in fp:
+            parts = line.split(None, 1)
+            if len(parts) < 2 or '(' not in parts[1]:
+                continue
+            if env.root not in parts[1]:  # only count workflow files
+                continue
+            name = parts[1].split('(', 1)[0]
+            counts[name] = counts.get(name, 0) + 1
+    return counts
+
+
+def _count_shim(env, args):
+    """Return counts of filesystem calls from :data:`TRACE_SHIM`."""
+    p = subprocess.Popen([sys.executable, '-c', TRACE_SHIM, 'mailto.py'] +
+                         args, env=env.env, cwd=SRCDIR,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, stderr = p.communicate()
+    for line in stderr.splitlines():
+        if line.startswith('SYSCALLS '):
+            return json.loads(line[9:])
+    raise RuntimeError('no syscall counts: {}'.format(stderr))
+
+
+def cmd_imports(args):
+    with Environment(args.contacts) as env:
+        env.run(['search', args.query])
+        p = subprocess.Popen([sys.executable, '-c', IMPORT_SHIM, 'mailto.py',
+                              'search', args.query], env=env.env,
+                             cwd=SRCDIR, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        _, stderr = p.communicate()
+        for line in stderr.splitlines():
+            if line.startswith('IMPORTS '):
+                data = json.loads(line[8:])
+                break
+        else:
+            raise RuntimeError('no import times: {}'.format(stderr))
+
+        timings = [env.run(['search', args.query])[0]
+                   for _ in range(args.runs)]
+
+    imports = data['imports']
+    print('{0:>10s} {1:>10s}  module'.format('cumul. ms', 'self ms'))
+    for name in sorted(imports, key=lambda n: -imports[n][0])[:args.top]:
+        cumulative, own = imports[name]
+        print('{0:10.1f} {1:10.1f}  {2}'.format(cumulative, own, name))
+    print('{0} modules, {1:.1f}ms importing, {2} Workflow object(s)'.format(
+          len(imports), sum(own for _, own in imports.values()),
+          data['workflows']))
+    report('search {!r}'.format(args.query), timings)
+
+
+def cmd_syscalls(args):
+    with Environment(args.contacts) as env:
+        env.run(['search', args.query])
+        try:
+            subprocess.call(['strace', '-V'], stdout=open(os.devnull, 'wb'))
+            counts = _count_strace(env, ['search', args.query])
+            tool = 'strace, workflow files only'
+        except OSError:
+            counts = _count_shim(env, ['search', args.query])
+            tool = 'Python-level, all files'
+
+    print('search {!r} ({}):'.format(args.query, tool))
+    for name in sorted(counts):
+        print('  {0:<12s} {1:5d}'.format(name, counts[name]))
+    print('  {0:<12s} {1:5d}'.format('total', sum(counts.values())))
+
+
+def cmd_locks(args):
+    tempdir = tempfile.mkdtemp(prefix='mailto-bench-')
+    try:
+        path = os.path.join(tempdir, 'settings.json')
+        start = time()
+        procs = [subprocess.Popen([sys.executable, '-c', LOCK_WORKER, path,
+                                   str(args.iterations),
+                                   str(args.hold / 1000.0),
+                                   '1' if i < args.readers else '0'],
+                                  stdout=subprocess.PIPE)
+                 for i in range(args.processes)]
+        waits = []
+        overlaps = 0
+        for p in procs:
+            data = json.loads(p.communicate()[0])
+            waits.extend(data['waits'])
+            overlaps += data['overlaps']
+        elapsed = time() - start
+    finally:
+        shutil.rmtree(tempdir)
+
+    waits.sort()
+    n = len(waits)
+    print('{0} processes ({1} readers) x {2} locks, held {3}ms'.format(
+          args.processes, args.readers, args.iterations, args.hold))
+    print('{0} locks in {1:.2f}s, {2:.0f} locks/s'.format(n, elapsed,
+                                                          n / elapsed))
+    print('wait: median={0:.1f}ms  p99={1:.1f}ms  max={2:.1f}ms'.format(
+          waits[n // 2] * 1000, waits[int(n * 0.99)] * 1000,
+          waits[-1] * 1000))
+    print('exclusive locks held at the same time as another: {}'.format(
+          overlaps))
+
+
+def cmd_background(args):
+    with Environment(10) as env:
+        cachedir = env.env['alfred_workflow_cache']
+        for mode in ('job', 'swr'):
+            name = 'bench-{}'.format(mode)
+            runs = os.path.join(env.root, name + '.runs')
+            cmd = [sys.executable, '-c', BACKGROUND_JOB, runs, name,
+                   str(args.duration)]
+            start = time() + 1.0  # time for the workers to import
+            procs = [subprocess.Popen([sys.executable, '-c',
+                                       BACKGROUND_WORKER, mode, name,
+                                       repr(start), json.dumps(cmd)],
+                                      env=env.env, cwd=SRCDIR,
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE)
+                     for _ in range(args.processes)]
+            launches = 0
+            for p in procs:
+                stdout, stderr = p.communicate()
+                if p.returncode:
+                    raise RuntimeError('worker failed: {}'.format(stderr))
+                launches += int(stdout)
+
+            # Wait for the job to finish
+            pidfile = os.path.join(cachedir, name + '.pid')
+            deadline = time() + args.duration + 10
+            while os.path.exists(pidfile) and time() < deadline:
+                sleep(0.05)
+
+            with open(runs) as fp:
+                regenerations = len(fp.readlines())
+
+            print('{0:<18s} {1} processes: {2} launch(es), '
+                  '{3} regeneration(s)'.format(
+                      'run_in_background' if mode == 'job'
+                      else 'cached_data_swr', args.processes, launches,
+                      regenerations))
+            if launches != 1 or regenerations != 1:
+                raise RuntimeError('{} started more than one job'.format(
+                                   mode))
+
+
+def make_rules_file(count, inline=True):
+    """Return client rules for ``count`` apps as commented JSON and data.
+
+    If ``inline`` is `False`, comments are only on lines of their own,
+    which is all the old parser (:func:`legacy_load`) understands.
+    """
+    rules = {}
+    lines = ['/*', 'Synthetic client rules', '*/', '{']
+    for i in range(count):
+        bundleid = 'com.example.app{0}'.format(i)
+        if i % 10 == 0:
+            bundleid += '.*'
+        rules[bundleid] = {'spaces': bool(i % 2), 'names': True,
+                           'mime': False, 'no_commas': bool(i % 3),
+                           'inline_to': False}
+        lines.append('  // App {0} (see http://example.com/{0})'.format(i))
+        lines.append('  {0}: {1}{2}{3}'.format(
+            json.dumps(bundleid), json.dumps(rules[bundleid]),
+            ',' if i < count - 1 else '', '  /* rules */' if inline else ''))
+    lines.append('}')
+    return '\n'.join(lines), rules
+
+
+def legacy_load(fp, *args, **kwargs):
+    """`verbose_json.load` before comments were stripped with a regex."""
+    from cStringIO import StringIO
+    real_json = []
+    in_multiline_comment = False
+    for line in fp:
+        l = line.strip()
+        if l.startswith(b'//'):
+            continue
+        if l.startswith(b'/*'):
+            in_multiline_comment = True
+            continue
+        if l.startswith(b'*/'):
+            in_multiline_comment = False
+            continue
+        if in_multiline_comment:
+            continue
+        real_json.append(line)
+
+    sio = StringIO(b'\n'.join(real_json))
+    return json.load(sio, *args, **kwargs)
+
+
+def reference_strip(s):
+    """Strip comments from ``s`` one character at a time.
+
+    A slow but simple version of `verbose_json.strip_comments` to
+    check it against. Returns `None` if a comment isn't terminated.
+    """
+    out = []
+    i, n = 0, len(s)
+    while i < n:
+        c = s[i]
+        if c == '"':
+            j = i + 1
+            while j < n and s[j] != '"':
+                j += 2 if s[j] == '\\' else 1
+            if j >= n:  # unterminated string
+                out.append(c)
+                i += 1
+                continue
+            out.append(s[i:j + 1])
+            i = j + 1
+        elif s.startswith('//', i):
+            j = s.find('\n', i)
+            j = n if j == -1 else j
+            out.append(' ' * (j - i))
+            i = j
+        elif s.startswith('/*', i):
+            j = s.find('*/', i + 2)
+            if j == -1:
+                return None
+            out.append(''.join(ch if ch == '\n' else ' '
+                               for ch in s[i:j + 2]))
+            i = j + 2
+        else:
+            out.append(c)
+            i += 1
+
+    return ''.join(out)
+
+
+# Fragments random texts are made of for `check_json_parity`
+FUZZ_PIECES = ['"', '\\', '/', '*', '//', '/*', '*/', '\n', ' ', 'a', '1',
+               '{', '}', ':', ',', '"a//b"', '"/*"', '"\\""', '"\\\\"',
+               '// c\n', '/* c */', '/* \n */', '\u00e9']
+
+
+def _parse(func, text):
+    """Return what ``func`` parses ``text`` into or the error it raises."""
+    try:
+        return func(text)
+    except ValueError as err:
+        return 'error: {}'.format(err)
+
+
+def check_json_parity(cases, seed=0):
+    """Compare `verbose_json.strip_comments` to :func:`reference_strip`.
+
+    Also checks that `verbose_json.loads` gives the same result (or
+    error) as parsing the output of `strip_comments`, and that comments
+    added to random JSON don't change the data it's parsed into.
+    Returns the number of mismatches.
+    """
+    import random
+    from verbose_json import loads, strip_comments
+
+    rand = random.Random(seed)
+    mismatches = 0
+    for i in range(cases):
+        text = ''.join(rand.choice(FUZZ_PIECES)
+                       for _ in range(rand.randint(0, 40)))
+        try:
+            result = strip_comments(text)
+        except ValueError:
+            result = None
+        if result != reference_strip(text):
+            mismatches += 1
+            print('mismatch: {!r}'.format(text))
+
+        if result is not None and (_parse(loads, text) !=
+                                   _parse(json.loads, result)):
+            mismatches += 1
+            print('loads mismatch: {!r}'.format(text))
+
+        data = [{'k{0}'.format(j): rand.choice(FUZZ_PIECES)}
+                for j in range(rand.randint(0, 5))]
+        lines = json.dumps(data, indent=1).split('\n')
+        for j in range(len(lines)):
+            if rand.random() < 0.3:
+                lines[j] += rand.choice([' // c */', ' /* "c" // */'])
+            if rand.random() < 0.2:
+                lines[j] = '/* "\n */' + lines[j]
+        if loads('\n'.join(lines)) != data:
+            mismatches += 1
+            print('data changed: {!r}'.format(data))
+
+    return mismatches
+
+
+def cmd_json(args):
+    sys.path.insert(0, SRCDIR)
+    import verbose_json
+    from cStringIO import StringIO
+
+    mismatches = check_json_parity(args.cases)
+    print('{0} random cases, {1} mismatches'.format(args.cases, mismatches))
+    if mismatches:
+        raise RuntimeError('verbose_json and reference parser disagree')
+
+    text, rules = make_rules_file(args.rules)
+    lines_only, _ = make_rules_file(args.rules, inline=False)
+    plain = json.dumps(rules)
+    for data in (text, lines_only):
+        if verbose_json.loads(data) != rules:
+            raise RuntimeError('verbose_json and json disagree')
+    if legacy_load(StringIO(lines_only)) != rules:
+        raise RuntimeError('old verbose_json and json disagree')
+
+    # Runs of the parsers are interleaved, so they're equally affected
+    # by whatever else the machine is doing
+    parsers = (
+        ('json', json.loads, plain),
+        ('old verbose_json', lambda s: legacy_load(StringIO(s)), lines_only),
+        ('verbose_json', verbose_json.loads, lines_only),
+        ('verbose_json (inline)', verbose_json.loads, text))
+    timings = {label: [] for label, _, _ in parsers}
+    for _ in range(args.runs):
+        for label, func, data in parsers:
+            start = time()
+            func(data)
+            timings[label].append(time() - start)
+
+    for label, _, _ in parsers:
+        report(label, timings[label])
+
+    print('{0} rules, {1:d} KB commented, {2:d} KB plain'.format(
+          args.rules, len(text) // 1024, len(plain) // 1024))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-c', '--contacts', type=int, default=1000,
+                        help='number of synthetic contacts (default: 1000)')
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('search', help='time searches')
+    p.add_argument('-n', '--runs', type=int, default=20)
+    p.add_argument('-p', '--phases', action='store_true',
+                   help='show time of each phase of search')
+    p.add_argument('query', nargs='?', default='person1')
+    p.set_defaults(func=cmd_search)
+
+    p = sub.add_parser('syscalls', help='count filesystem calls')
+    p.add_argument('query', nargs='?', default='person1')
+    p.set_defaults(func=cmd_syscalls)
+
+    p = sub.add_parser('imports', help='report import times')
+    p.add_argument('-n', '--runs', type=int, default=10)
+    p.add_argument('-t', '--top', type=int, default=20,
+                   help='number of modules to show (default: 20)')
+    p.add_argument('query', nargs='?', default='person1')
+    p.set_defaults(func=cmd_imports)
+
+    p = sub.add_parser('compose', help='time batch compose')
+    p.add_argument('-n', '--runs', type=int, default=10)
+    p.add_argument('-l', '--lists', type=int, default=1000,
+                   help='number of recipient lists (default: 1000)')
+    p.set_defaults(func=cmd_compose)
+
+    p = sub.add_parser('json', help='time comment-stripping JSON parser')
+    p.add_argument('-n', '--runs', type=int, default=20)
+    p.add_argument('-r', '--rules', type=int, default=5000,
+                   help='number of client rules (default: 5000)')
+    p.add_argument('--cases', type=int, default=3000,
+                   help='number of random parity checks (default: 3000)')
+    p.set_defaults(func=cmd_json)
+
+    p = sub.add_parser('serializers', help='compare cache serializers')
+    p.add_argument('-n', '--runs', type=int, default=20)
+    p.set_defaults(func=cmd_serializers)
+
+    p = sub.add_parser('logging', help='time runs with debug logging')
+    p.add_argument('-n', '--runs', type=int, default=10)
+    p.add_argument('-l', '--lists', type=int, default=1000,
+                   help='number of recipient lists (default: 1000)')
+    p.add_argument('query', nargs='?', default='person1')
+    p.set_defaults(func=cmd_logging)
+
+    p = sub.add_parser('locks', help='time contended file locks')
+    p.add_argument('-p', '--processes', type=int, default=16)
+    p.add_argument('-n', '--iterations', type=int, default=50,
+                   help='locks per process (default: 50)')
+    p.add_argument('-r', '--readers', type=int, default=0,
+                   help='processes that take shared locks (default: 0)')
+    p.add_argument('--hold', type=float, default=1.0,
+                   help='how long to hold each lock in ms (default: 1)')
+    p.set_defaults(func=cmd_locks)
+
+    p = sub.add_parser('background', help='check background jobs start once')
+    p.add_argument('-p', '--processes', type=int, default=16)
+    p.add_argument('-d', '--duration', type=float, default=2.0,
+                   help='how long the job runs in seconds (default: 2)')
+    p.set_defaults(func=cmd_background)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,27 +8,53 @@
 # Created on 2013-12-05
 #
 
-"""test_client [-h|--help] <client>
-
-Call specified client with a series of mailto: URLs to test support
-
-Usage:
-    test_client <client>
-    test_client (-h|--help)
-
-Options:
-    -h, --help  Show this help message.
+"""test_client.py [options] <client>
+
+Work out which formatting rules an email client needs.
+
+Builds a mailto: URL for every combination of `Formatter` rules
+(spaces, names, mime, no_commas, inline_to), sends each one to the
+client via an adapter and checks which recipients come out the other
+end. Prints the results and a `client_rules.json` fragment with the
+best rules.
+
+Adapters:
+    local        Parse the URLs with a stand-in client. Use --quirk to
+                 make it behave like a real client (see below). Probes
+                 run in parallel.
+    interactive  Open each URL in <client> with `open -a` and ask
+                 whether the recipients are right.
+
+Quirks of the local client:
+    no-mime       doesn't decode MIME-encoded names
+    split-commas  splits recipients on every comma, even in quotes
+    inline-only   ignores `?to=`, only reads `mailto:<recipients>`
+    no-spaces     doesn't strip spaces after commas
+    needs-spaces  only splits recipients on ", "
 """
 
-from __future__ import print_function
-
+from __future__ import print_function, unicode_literals
 
+import argparse
+from collections import OrderedDict
+from email.header import decode_header
+from itertools import product
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+import os
 from subprocess import check_call
-from time import sleep
-from email.header import Header
-from urllib import quote
-import docopt
+import sys
+from urllib import unquote
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src'))
+
+from client import DEFAULT_RULES, ClientRules, Formatter  # noqa: E402
+import recipients as rcpt  # noqa: E402
 
+# Names with non-ASCII characters and commas are the ones clients
+# disagree on
 contacts = [
     ('Bob Test', 'bob@deanishe.net'),
     ('Sue Test', 'sue@deanishe.net'),
@@ -38,145 +64,213 @@ contacts = [
     ('Harry Test — Splendid, Inc.', 'harry@deanishe.net')
 ]
 
-WAIT_FOR = 5  # seconds
+RULE_KEYS = ('spaces', 'names', 'mime', 'no_commas', 'inline_to')
 
-URLS = [
+QUIRKS = ('no-mime', 'split-commas', 'inline-only', 'no-spaces',
+          'needs-spaces')
 
-('Name, email, space, MIME-encoded, URL-quoted', 'mailto:?to=Bob%20Test%20%3Cbob%40example.com%3E%2C%20Sue%20Test%20%3Csue%40example.com%3E%2C%20Dave%20Test%20%3Cdave%40example.com%3E%2C%20%3D%3Futf-8%3Fq%3FJ%3DC3%3DBCrgen_Probe%3F%3D%20%3Cprobi%40example.com%3E%2C%20%22Probe%2C%20Heinrich%2C%20Dr.%22%20%3Cheini%40example.com%3E%2C%20%3D%3Futf-8%3Fb%3FIkhhcnJ5IFRlc3Qg4oCUIFNwbGVuZGlkLCBJbmMuIg%3D%3D%3F%3D%20%3Charry%40example.com%3E&subject=Name%20%26%20email%2C%20with%20space%2C%20MIME-encoded%2C%20URL-quoted'),  # default (Mail, MailMate, Thunderbird)
-('Email-only, no space', 'mailto:?to=bob@example.com,sue@example.com,dave@example.com,probi@example.com,heini@example.com,harry@example.com&subject=Email%20only%2C%20no%20space'),  # Airmail
-('Name, email, space. Email-only if commas', 'mailto:?to=Bob Test <bob@example.com>,Sue Test <sue@example.com>,Dave Test <dave@example.com>,Jürgen Probe <probi@example.com>,heini@example.com,harry@example.com&subject=Name &amp; email, no space, email only if commas'),  # Unibox
-('Name, email, space. Quotes for commas', 'mailto:?to=Bob Test <bob@example.com>, Sue Test <sue@example.com>, Dave Test <dave@example.com>, Jürgen Probe <probi@example.com>, "Probe, Heinrich, Dr." <heini@example.com>, "Harry Test — Splendid, Inc." <harry@example.com>&subject=Name%20%26%20email%2C%20with%20space%2C%20MIME-encoded%2C%20URL-quoted')  # Sparrow
-]
+# Bundle ID the probe rules are registered under
+PROBE_ID = 'net.deanishe.alfred-mailto.probe'
+
+
+class _Workflow(object):
+    """The bit of `Workflow` that `Formatter` uses."""
+
+    logger = logging.getLogger('test_client')
+
+
+def rule_matrix():
+    """Return list of all combinations of formatting rules."""
+    return [OrderedDict(zip(RULE_KEYS, values))
+            for values in product((True, False), repeat=len(RULE_KEYS))]
+
+
+def build_url(rules):
+    """Return mailto: URL for :data:`contacts` formatted per ``rules``."""
+    formatter = Formatter(PROBE_ID, _Workflow(),
+                          ClientRules({'exact': {PROBE_ID: rules},
+                                       'globs': []}))
+    return formatter.get_url(contacts, use_names=True)
+
+
+def _decode_name(name):
+    """Decode MIME encoded-words in ``name``."""
+    if name is None or '=?' not in name:
+        return name
+
+    return ''.join(s.decode(charset or 'ascii')
+                   for s, charset in decode_header(name))
+
+
+class LocalAdapter(object):
+    """Stand-in email client that parses mailto: URLs.
+
+    Without any quirks, it understands everything `Formatter` can
+    produce.
+
+    :param client: name of client (unused)
+    :type client: ``unicode``
+    :param quirks: names of quirks from :data:`QUIRKS`
+    :type quirks: ``list``
 
+    """
 
-def encode(s):
-    return Header(s, charset='utf-8')
+    parallel = True
 
+    def __init__(self, client, quirks=()):
+        self.client = client
+        self.quirks = set(quirks)
 
-def enquoten(s):
-    if ',' in s:
-        return '"{}"'.format(s)
-    return s
+    def probe(self, url):
+        """Return list of ``(name, email)`` the client gets from ``url``."""
+        assert url.startswith(b'mailto:')
+        path, _, query = url[7:].partition(b'?')
+        to = []
+        if path:
+            to.append(unquote(path))
 
+        if query and 'inline-only' not in self.quirks:
+            for param in query.split(b'&'):
+                key, _, value = param.partition(b'=')
+                if key.lower() == b'to':
+                    to.append(unquote(value))
 
-def open_url(client, url):
-    print(url)
-    check_call(['open', '-a', client, url])
-    print('')
-    return did_it_work()
-    # sleep(WAIT_FOR)
+        text = b','.join(to).decode('utf-8')
 
+        if 'needs-spaces' in self.quirks:
+            parts = text.split(', ')
+        elif 'split-commas' in self.quirks:
+            parts = text.split(',')
+        else:
+            parts = rcpt.split(text)
 
-def build_url(to, subject):
-    print('')
-    print(subject)
-    # return 'mailto:{}?subject={}'.format(to, subject.replace('&', 'and'))
-    return 'mailto:?to={}&subject={}'.format(to, subject.replace('&', 'and'))
+        if 'no-spaces' not in self.quirks:
+            parts = [s.strip() for s in parts]
 
+        result = []
+        for part in parts:
+            if not part:
+                continue
+            name, email = rcpt.parse(part)
+            if 'no-spaces' in self.quirks and name is None:
+                email = part  # don't strip whitespace
+            if 'no-mime' not in self.quirks:
+                name = _decode_name(name)
+            result.append((name, email))
 
-def did_it_work():
-    response = None
-    while response not in ('y', 'n'):
-        response = raw_input('Did it work? [y/n] ').lower()
+        return result
 
-    return response == 'y'
+
+class InteractiveAdapter(object):
+    """Open URLs in a real client and ask the user whether they worked."""
+
+    parallel = False
+
+    def __init__(self, client, quirks=()):
+        self.client = client
+
+    def probe(self, url):
+        """Return expected recipients if the user says they're right."""
+        print(url)
+        check_call(['open', '-a', self.client, url])
+        response = None
+        while response not in ('y', 'n'):
+            response = raw_input('Are the recipients right? [y/n] ').lower()
+
+        if response == 'y':
+            return LocalAdapter(self.client).probe(url)
+
+        return []
+
+
+ADAPTERS = {'local': LocalAdapter, 'interactive': InteractiveAdapter}
+
+
+def score(rules, received):
+    """Return sortable score for probe or ``None`` if it failed.
+
+    A probe fails unless all addresses arrive, in order. Probes that
+    deliver more names score higher, then those closest to the
+    default rules.
+
+    """
+    if [email for _, email in received] != [email for _, email in contacts]:
+        return None
+
+    names = sum(1 for (name, _), (expected, _) in zip(received, contacts)
+                if name == expected)
+    defaults = sum(1 for key in RULE_KEYS if rules[key] == DEFAULT_RULES[key])
+    return (names, defaults)
+
+
+def run_probes(adapter, jobs):
+    """Return list of ``(rules, url, received, score)`` for all rules."""
+    matrix = rule_matrix()
+    urls = [build_url(rules) for rules in matrix]
+
+    if adapter.parallel and jobs > 1:
+        pool = ThreadPool(jobs)
+        try:
+            received = pool.map(adapter.probe, urls)
+        finally:
+            pool.close()
+    else:
+        received = [adapter.probe(url) for url in urls]
+
+    return [(rules, url, r, score(rules, r))
+            for rules, url, r in zip(matrix, urls, received)]
+
+
+def report(results):
+    """Print table of probe results."""
+    print(' '.join('{:9s}'.format(key) for key in RULE_KEYS) +
+          ' result')
+    for rules, _, received, result in results:
+        flags = ' '.join('{:9s}'.format('yes' if rules[key] else '-')
+                         for key in RULE_KEYS)
+        if result is None:
+            outcome = 'FAIL ({} recipients)'.format(len(received))
+        else:
+            outcome = 'ok   ({} of {} names)'.format(result[0],
+                                                      len(contacts))
+        print(flags + ' ' + outcome)
 
 
 def main():
-    args = docopt.docopt(__doc__)
-    client = args.get('<client>')
-    results = []
-    print("Testing client '{}' ...".format(client))
-
-    if True:
-        title = 'Email only, no space'
-        parts = [email for (name, email) in contacts]
-        url = build_url(','.join(parts), title)
-        results.append((title, open_url(client, url)))
-
-        title = 'Email only, with space'
-        parts = [email for (name, email) in contacts]
-        url = build_url(', '.join(parts), title)
-        results.append((title, open_url(client, url)))
-
-        title = 'Name & email, quoted, no space'
-        parts = []
-        for name, email in contacts:
-            name = enquoten(name)
-            parts.append('{} <{}>'.format(name, email))
-        url = build_url(','.join(parts), title)
-        results.append((title, open_url(client, url)))
-
-        title = 'Name & email, quoted, with space'
-        parts = []
-        for name, email in contacts:
-            name = enquoten(name)
-            parts.append('{} <{}>'.format(name, email))
-        url = build_url(', '.join(parts), title)
-        results.append((title, open_url(client, url)))
-
-        title = 'Name & email, no space, MIME-encoded'
-        parts = []
-        for name, email in contacts:
-            name = enquoten(name)
-            name = encode(name)
-            parts.append('{} <{}>'.format(name, email))
-        url = build_url(','.join(parts), title)
-        results.append((title, open_url(client, url)))
-
-        title = 'Name & email, with space, MIME-encoded'
-        parts = []
-        for name, email in contacts:
-            name = enquoten(name)
-            name = encode(name)
-            parts.append('{} <{}>'.format(name, email))
-        url = build_url(', '.join(parts), title)
-        results.append((title, open_url(client, url)))
-
-        title = 'Name & email, no space, MIME-encoded, URL-encoded'
-        parts = []
-        for name, email in contacts:
-            name = enquoten(name)
-            name = encode(name)
-            parts.append('{} <{}>'.format(name, email))
-        url = build_url(quote(','.join(parts)), quote(title))
-        results.append((title, open_url(client, url)))
-
-    if False:
-        title = 'Name & email, with space, MIME-encoded, URL-encoded'
-        parts = []
-        for name, email in contacts:
-            name = enquoten(name)
-            # name = encode(name)
-            parts.append('{} <{}>'.format(name, email))
-        url = build_url(', '.join(parts), quote(title))
-        results.append((title, open_url(client, url)))
-
-    if True:
-        title = 'Name & email, no space, email only if commas'
-        parts = []
-        for name, email in contacts:
-            if ',' in name:
-                parts.append(email)
-            else:
-                # name = enquoten(name)
-                # name = encode(name)
-                parts.append('{} <{}>'.format(name, email))
-        url = build_url(','.join(parts), title)
-        results.append((title, open_url(client, url)))
-
-    if False:
-
-        for title, url in URLS:
-            print(title)
-            print('{!r}'.format(url))
-            open_url(client, url)
-            results.append((title, did_it_work()))
-
-    print('\n\nResults for {}:'.format(client))
-
-    for (title, success) in results:
-        print('\t{:5s} : {}'.format(str(success), title))
+    parser = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[1],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-a', '--adapter', choices=sorted(ADAPTERS),
+                        default='local',
+                        help='how to check the URLs (default: local)')
+    parser.add_argument('-q', '--quirk', action='append', default=[],
+                        choices=QUIRKS,
+                        help='quirk of local client (may be repeated)')
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help='probes to run at once (default: 8)')
+    parser.add_argument('-b', '--bundleid',
+                        help='bundle ID for rules (default: <client>)')
+    parser.add_argument('client', help='name of email client')
+    args = parser.parse_args()
+
+    adapter = ADAPTERS[args.adapter](args.client, args.quirk)
+    results = run_probes(adapter, args.jobs)
+
+    print("Results for '{}':\n".format(args.client))
+    report(results)
+
+    passed = [(result, rules) for rules, _, _, result in results
+              if result is not None]
+    if not passed:
+        print('\nNo combination of rules works.')
+        return 1
+
+    best = max(passed, key=lambda t: t[0])[1]
+    print('\nclient_rules.json fragment:\n')
+    print(json.dumps({args.bundleid or args.client: best}, indent=2,
+                     separators=(',', ': ')))
+    return 0
+
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -12,24 +12,30 @@
 
 from __future__ import print_function, unicode_literals, absolute_import
 
-from email.header import Header
-from fnmatch import fnmatch
+from collections import OrderedDict
+import fnmatch
+import logging
 import os
 import re
 from time import time
-from urllib import quote
 
-from workflow.background import run_in_background, is_running
+from workflow.background import is_running
 
-from common import ONE_DAY, appname, bundleid
+from common import ONE_WEEK, appname, bundleid
+from nameindex import NameIndex
+import recipients as rcpt
+from store import GenerationStore
 import verbose_json as json
+from watcher import apps_source
 
 log = None
 
 match_bundle_id = re.compile(r'kMDItemCFBundleIdentifier = "(.+)"').match
 
 
-MAX_APP_CACHE_AGE = ONE_DAY
+# Application caches are reloaded when an app is installed or removed
+# or the default mailto: handler is changed, so this is only a fallback
+MAX_APP_CACHE_AGE = ONE_WEEK
 
 
 # Client-specific formatting rules
@@ -60,6 +66,158 @@ DEFAULT_RULES = {
 # adjacent to this file and the file of the same name in the workflow's
 # data directory (if it exists and contains anything).
 # The file in the data directory overrides the default one.
+#
+# The files are compiled into a table (see `compile_client_rules()`),
+# which is cached until one of the files is changed.
+# Increment when the format or meaning of the table changes.
+RULES_VERSION = 2
+
+# Number of MIME-encoded names `Formatter` keeps between URLs. The
+# cache is emptied before a URL if it has grown larger than this.
+NAME_CACHE_SIZE = 10000
+
+# `update_apps.py` caches the list of email clients, the system default
+# client and the compiled client rules in a single "client snapshot",
+# which is published as a generation of the `client_snapshot` store.
+# Increment when the format of the snapshot changes.
+SNAPSHOT_VERSION = 4
+
+
+def client_rules_paths(wf):
+    """Return paths to default and user's ``client_rules.json`` files."""
+    return [wf.workflowfile('client_rules.json'),
+            wf.datafile('client_rules.json')]
+
+
+def client_rules_mtimes(wf):
+    """Return modification times of ``client_rules.json`` files.
+
+    The mtime of a file that doesn't exist is `None`.
+    """
+    mtimes = []
+    for path in client_rules_paths(wf):
+        try:
+            mtimes.append(os.stat(path).st_mtime)
+        except OSError:
+            mtimes.append(None)
+
+    return mtimes
+
+
+def load_client_rules(wf):
+    """Load client rules from ``client_rules.json`` files.
+
+    Returns a list of ordered mappings, one per existing file, with
+    the user's file (which has priority) first.
+    """
+    client_rules = []
+    for path in reversed(client_rules_paths(wf)):
+        if not os.path.exists(path):
+            continue
+        wf.logger.debug(
+            'Loading client formatting rules from {} ...'.format(path))
+        with open(path) as fp:
+            client_rules.append(json.load(fp, object_pairs_hook=OrderedDict))
+
+    return client_rules
+
+
+def compile_client_rules(wf, mtimes=None):
+    """Merge client rules from ``client_rules.json`` files into a table.
+
+    Rules for a bundle ID in the user's file replace those in the
+    default file. Bundle IDs without wildcards go in a dict, patterns
+    are translated to regular expressions and kept in the order they
+    should be tried in: the user's, then the default ones, each in the
+    order they appear in the file.
+
+    Exact IDs are looked up before patterns, so a default exact ID that
+    matches one of the user's patterns is dropped. Otherwise, it would
+    override the user's rules.
+
+    {
+        'version': RULES_VERSION,
+        'mtimes': [mtime of default file, mtime of user file],
+        'exact': {bundle ID: rules, ...},
+        'globs': [(pattern, regex, rules), ...],
+    }
+
+    """
+    table = {'version': RULES_VERSION,
+             'mtimes': mtimes or client_rules_mtimes(wf),
+             'exact': {}, 'globs': []}
+    seen = set()
+    # Patterns from files with higher priority
+    overrides = []
+    for client_rules in load_client_rules(wf):
+        patterns = []
+        for key, rules in client_rules.items():
+            if key in seen:
+                continue
+            seen.add(key)
+            rules = dict(rules)
+            if any(c in key for c in '*?['):
+                regex = fnmatch.translate(key)
+                table['globs'].append((key, regex, rules))
+                patterns.append(re.compile(regex).match)
+            elif not any(match(key) for match in overrides):
+                table['exact'][key] = rules
+
+        overrides.extend(patterns)
+
+    return table
+
+
+def cached_client_rules(wf, table=None):
+    """Return :class:`ClientRules` for current ``client_rules.json`` files.
+
+    ``table`` (e.g. from the client snapshot) is used if the files
+    haven't changed since it was compiled. Otherwise, the table is
+    loaded from the cache or compiled and cached afresh.
+
+    """
+    mtimes = client_rules_mtimes(wf)
+
+    def stale(table):
+        return (table is None or table.get('version') != RULES_VERSION or
+                table.get('mtimes') != mtimes)
+
+    if stale(table):
+        table = wf.cached_data('client_rules', max_age=0)
+        if stale(table):
+            table = compile_client_rules(wf, mtimes)
+            wf.cache_data('client_rules', table)
+
+    return ClientRules(table)
+
+
+class ClientRules(object):
+    """Compiled client rules.
+
+    :param table: table returned by :func:`compile_client_rules`
+    :type table: ``dict``
+
+    """
+
+    def __init__(self, table):
+        self.exact = table['exact']
+        self.globs = [(re.compile(regex).match, rules)
+                      for _, regex, rules in table['globs']]
+
+    def get(self, bundleid, default=None):
+        """Return rules for ``bundleid`` or ``default``."""
+        if bundleid is None:
+            return default
+
+        rules = self.exact.get(bundleid)
+        if rules is not None:
+            return rules
+
+        for match, rules in self.globs:
+            if match(bundleid):
+                return rules
+
+        return default
 
 
 # oooooooooooo                                                    .       .
@@ -78,34 +236,83 @@ class Formatter(object):
 
     """
 
-    def __init__(self, client, wf):
+    def __init__(self, client, wf, client_rules=None):
         global log
         self.client = client
         self.wf = wf
         log = self.wf.logger
         # Load rules
-        client_rules = {}
-        for path in [self.wf.workflowfile('client_rules.json'),
-                     self.wf.datafile('client_rules.json')]:
-            if not os.path.exists(path):
-                continue
-            log.debug(
-                'Loading client formatting rules from {} ...'.format(path))
-            with open(path) as fp:
-                client_rules.update(json.load(fp))
-        self.rules = DEFAULT_RULES
+        if client_rules is None:
+            client_rules = cached_client_rules(self.wf)
         # Get rules for selected client
-        for bundle_id in client_rules:
-            if fnmatch(client, bundle_id):
-                self.rules = client_rules.get(bundle_id)
-                break
+        self.rules = client_rules.get(client, DEFAULT_RULES)
 
         for key in ('spaces', 'names', 'mime', 'no_commas', 'inline_to'):
             value = self.rules[key]
             setattr(self, 'use_{}'.format(key), value)
 
-        log.debug(u'Loaded rules {!r} for client {!r}'.format(self.rules,
-                                                              client))
+        log.debug('Loaded rules %r for client %r', self.rules, client)
+        # Checked once, as there are log messages for every recipient
+        self._debug = log.isEnabledFor(logging.DEBUG)
+
+        # MIME-encoded names. Encoding is much slower than the rest of
+        # formatting, and the same people occur again and again in
+        # groups and batches.
+        # {name: encoded name}
+        self._encoded_names = {}
+
+    def _encode_name(self, name):
+        """Return MIME-encoded ``name``."""
+        encoded = self._encoded_names.get(name)
+        if encoded is None:
+            # Imported here because `email` is slow to import and
+            # rarely needed
+            from email.header import Header
+            encoded = self._encoded_names[name] = str(Header(name, 'utf-8'))
+
+        return encoded
+
+    def format_recipient(self, name, email, use_names=True):
+        """Return recipient formatted for URL and whether it's MIME-encoded.
+
+        :param name: name of recipient or ``None``
+        :param email: email address of recipient
+        :param use_names: include recipient's name
+        :returns: 2-tuple ``(fragment, encoded)``
+
+        """
+        contact = (name, email)
+        if not use_names:
+            if self._debug:
+                log.debug('[not use_names] %r --> %r', contact, email)
+            return email, False
+
+        elif name is None:  # email addy not in Address Book
+            if self._debug:
+                log.debug('[name not found] %r --> %r', contact, email)
+            return email, False
+
+        encoded = False
+        if self.use_mime:
+            try:
+                name = name.encode('ascii')
+            except UnicodeEncodeError:
+                name = self._encode_name(name)
+                encoded = True
+
+        if ',' in name:
+            if self.use_no_commas:
+                if self._debug:
+                    log.debug('[use_no_commas] %r --> %r', contact, email)
+                return email, encoded
+
+            else:
+                name = '"{}"'.format(name)
+
+        addr = '{} <{}>'.format(name, email)
+        if self._debug:
+            log.debug('[default] %r --> %r', contact, addr)
+        return addr, encoded
 
     def get_url(self, contacts, use_names=False):
         """Return formatted unicode URL for contacts
@@ -113,43 +320,19 @@ class Formatter(object):
         :param contacts: list of 2-tuples: (name, email)
         :returns: string (bytes)
         """
-        log.debug(u"Building URL for app '{}'".format(self.client))
+        if self._debug:
+            log.debug("Building URL for app '%s'", self.client)
+        # Emptied here, not while formatting, so a group larger than
+        # the cache still gets each name encoded just once
+        if len(self._encoded_names) > NAME_CACHE_SIZE:
+            self._encoded_names.clear()
+        use_names = self.use_names and use_names
         parts = []
         encoded = False
-        for contact in contacts:
-            name, email = contact
-            if not self.use_names or not use_names:
-                parts.append(email)
-                log.debug('[not use_names] {!r} --> {!r}'.format(contact,
-                                                                 email))
-                continue
-
-            elif name is None:  # email addy not in Address Book
-                parts.append(email)
-                log.debug('[name not found] {!r} --> {!r}'.format(contact,
-                                                                  email))
-                continue
-
-            if self.use_mime:
-                try:
-                    name = name.encode('ascii')
-                except UnicodeEncodeError:
-                    name = str(Header(name, 'utf-8'))
-                    encoded = True
-
-            if ',' in name:
-                if self.use_no_commas:
-                    parts.append(email)
-                    log.debug('[use_no_commas] {!r} --> {!r}'.format(contact,
-                                                                     email))
-                    continue
-
-                else:
-                    name = '"{}"'.format(name)
-
-            addr = '{} <{}>'.format(name, email)
-            log.debug('[default] {!r} --> {!r}'.format(contact, addr))
-            parts.append(addr)
+        for name, email in contacts:
+            part, part_encoded = self.format_recipient(name, email, use_names)
+            parts.append(part)
+            encoded = encoded or part_encoded
 
         if self.use_spaces:
             result = ', '.join(parts)
@@ -159,6 +342,7 @@ class Formatter(object):
         result = result.encode('utf-8')
 
         if encoded:  # also needs quoting
+            from urllib import quote
             result = quote(result, safe='@')
         if self.use_inline_to:
             return b'mailto:{}'.format(result)
@@ -186,6 +370,7 @@ class Client(object):
         log = wf.logger
         self.all_email_apps = []
         self.system_default_app = {}
+        self._client_rules = None
         self.update()
 
     def get_default_app(self):
@@ -212,17 +397,26 @@ class Client(object):
     default_app = property(get_default_app, set_default_app)
 
     def build_url(self, emails):
-        """Return mailto: URL built with appropriate formatter"""
-        contacts = self.wf.cached_data('contacts', max_age=0)
+        """Return mailto: URL built with appropriate formatter
 
-        if not contacts:
-            raise ValueError('No contacts available')
+        ``emails`` may be bare addresses or ``Name <address>``. Names
+        from Contacts take precedence.
 
-        email_name_map = contacts['email_name_map']
+        """
+        return next(self.build_urls([emails]))
 
-        # [(name, email), ...]
-        recipients = [(email_name_map.get(email), email) for
-                      email in emails]
+    def build_urls(self, email_lists):
+        """Generate a mailto: URL for each list of emails in ``email_lists``.
+
+        The name index, client rules and settings are only loaded once,
+        so this is much faster than calling :meth:`build_url` for each
+        list.
+
+        """
+        pointer = self.wf.cached_data('contacts', max_age=0)
+
+        if not pointer or 'names.idx' not in pointer.get('files', {}):
+            raise ValueError('No contacts available')
 
         app = self.default_app
 
@@ -232,33 +426,83 @@ class Client(object):
         elif isinstance(app, basestring):
             bundleid = app
 
-        formatter = Formatter(bundleid, self.wf)
-        return formatter.get_url(recipients,
-                                 self.wf.settings.get('use_name', True))
+        formatter = Formatter(bundleid, self.wf, self.client_rules)
+        use_name = self.wf.settings.get('use_name', True)
+
+        names = self._open_name_index(pointer)
+        try:
+            for emails in email_lists:
+                # [(name, email), ...]
+                recipients = []
+                for recipient in emails:
+                    name, email = rcpt.parse(recipient)
+                    if names is not None:
+                        name = names.get(email) or name
+                    recipients.append((name, email))
+                yield formatter.get_url(recipients, use_name)
+        finally:
+            if names is not None:
+                names.close()
+
+    def _open_name_index(self, pointer):
+        """Return :class:`~nameindex.NameIndex` of ``pointer`` or `None`.
+
+        If the generation ``pointer`` points to has been deleted since
+        it was loaded, the current pointer is loaded and tried once.
+        If that fails too, `None` is returned and recipients keep the
+        names they were given.
+
+        """
+        store = GenerationStore(self.wf, 'contacts')
+        for retry in (False, True):
+            if retry:
+                latest = self.wf.cached_data('contacts', max_age=0)
+                if (not latest or 'names.idx' not in latest.get('files', {})
+                        or latest['generation'] == pointer['generation']):
+                    break
+                pointer = latest
+
+            try:
+                return NameIndex(store.path(pointer, 'names.idx'))
+            except (IOError, OSError, ValueError) as err:
+                log.warning('Error opening name index : %s', err)
+
+        return None
+
+    @property
+    def client_rules(self):
+        """Compiled client formatting rules.
+
+        Taken from the client snapshot unless a ``client_rules.json``
+        file has been changed since the snapshot was built.
+
+        """
+        return cached_client_rules(self.wf, self._client_rules)
 
     def update(self, force=False):
         """Load apps from cache, update if required"""
-        self.all_email_apps = self.wf.cached_data('all_apps', max_age=0)
-        self.system_default_app = self.wf.cached_data('system_default_app',
-                                                      max_age=0)
-        if self.all_email_apps is None:
-            self.all_email_apps = []
-        if self.system_default_app is None:
-            self.system_default_app = {}
-
-        do_update = False
-        if force:
-            do_update = True
-        elif not self.wf.cached_data_fresh('all_apps', MAX_APP_CACHE_AGE):
-            do_update = True
-        elif not self.wf.cached_data_fresh('system_default_app',
-                                           MAX_APP_CACHE_AGE):
-            do_update = True
-        # Update if required
-        if do_update:
-            log.debug('Updating application caches ...')
+        def stale(pointer):
+            return (pointer.get('version') != SNAPSHOT_VERSION or
+                    apps_source().changed(pointer.get('fingerprint')))
+
+        with self.wf.span('client.update'):
             cmd = ['/usr/bin/python', self.wf.workflowfile('update_apps.py')]
-            run_in_background('update-apps', cmd)
+            pointer = self.wf.cached_data_swr('client_snapshot', cmd,
+                                              MAX_APP_CACHE_AGE,
+                                              job='update-apps',
+                                              stale_func=stale, force=force)
+
+            snapshot = {}
+            if pointer and pointer.get('version') == SNAPSHOT_VERSION:
+                store = GenerationStore(self.wf, 'client_snapshot')
+                try:
+                    snapshot = store.load(pointer, 'snapshot')
+                except IOError as err:  # generation has been deleted
+                    log.warning('Error loading client snapshot : %s', err)
+
+            self.all_email_apps = snapshot.get('apps', [])
+            self.system_default_app = snapshot.get('system_default_app', {})
+            self._client_rules = snapshot.get('client_rules')
 
     @property
     def updating(self):
@@ -277,7 +521,7 @@ if __name__ == '__main__':
         s = time()
         func(*args, **kwargs)
         d = time() - s
-        log.debug('{} run in {:0.3f} seconds'.format(func.__name__, d))
+        log.debug('%s run in %0.3f seconds', func.__name__, d)
 
     c = Client(wf)
     wf.reset()
@@ -14,12 +14,9 @@ from __future__ import print_function, unicode_literals, absolute_import
 
 
 import os
-import subprocess
+import re
 
-from workflow import Workflow
-
-wf = Workflow()
-log = wf.logger
+from workflow import current_workflow
 
 ONE_DAY = 86400
 ONE_HOUR = 3600
@@ -33,12 +30,37 @@ tell application "Finder"
 end tell
 '''
 
+# Characters `quote()` leaves unquoted (the same as `pipes.quote`)
+_unsafe = re.compile(r'[^\w@%+=:,./-]')
+
+
+def wf():
+    """Return the process's workflow object."""
+    return current_workflow()
+
+
+def _log():
+    return wf().logger
+
 
 def _applescriptify(text):
     """Replace double quotes in text."""
     return text.replace('"', '" + quote + "')
 
 
+def quote(s):
+    """Return ``s`` quoted for the shell, like :func:`pipes.quote`.
+
+    :mod:`pipes` imports :mod:`tempfile`, which is slow to import, and
+    search results use this for every item.
+    """
+    if not s:
+        return "''"
+    if _unsafe.search(s) is None:
+        return s
+    return "'" + s.replace("'", "'\"'\"'") + "'"
+
+
 def appname(app_path):
     """Return app name for application at ``app_path``."""
     return os.path.splitext(os.path.basename(app_path))[0]
@@ -53,7 +75,7 @@ def bundleid(app_path):
 
 def nsurl_to_path(nsurl):
     """Convert a file:// NSURL object to a Unicode path."""
-    return wf.decode(nsurl.path()).rstrip('/')
+    return wf().decode(nsurl.path()).rstrip('/')
 
 
 def reveal_in_finder(path):
@@ -64,19 +86,26 @@ def reveal_in_finder(path):
 
 
 def run_alfred(query):
-    """Run Alfred with ``query`` via AppleScript."""
+    """Run Alfred with ``query`` via AppleScript.
+
+    Settings are saved first, as the workflow run by ``query`` will
+    probably read them.
+    """
+    wf().settings.flush()
     script = ALFRED_SCRIPT.format(_applescriptify(query))
-    log.debug('calling Alfred with : %r', script)
+    _log().debug('calling Alfred with : %r', script)
+    import subprocess
     return subprocess.call(['osascript', '-e', script])
 
 
 def command_output(cmd):
     """Wraps :func:`subprocess.check_output` and decode output."""
-    log.debug('Running command : %r', cmd)
-    return wf.decode(subprocess.check_output(cmd)).strip()
+    _log().debug('Running command : %r', cmd)
+    import subprocess
+    return wf().decode(subprocess.check_output(cmd)).strip()
 
 
 def command_lines(cmd):
     """Return results of :func:`command_output` as a list of lines."""
-    log.debug('Running command : %r', cmd)
+    _log().debug('Running command : %r', cmd)
     return [s.strip() for s in command_output(cmd).split('\n') if s.strip()]
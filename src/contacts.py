@@ -14,35 +14,82 @@ from __future__ import print_function, unicode_literals, absolute_import
 
 from operator import itemgetter
 
-from workflow import Workflow
-from workflow.background import run_in_background, is_running
+from workflow import current_workflow, manager
+from workflow.background import is_running
 
-wf = Workflow()
-log = wf.logger
+from nameindex import NameIndex
+from store import GenerationStore
+from watcher import contacts_source
 
+log = None
 
-MAX_CACHE_AGE = 3600  # 1 hour
+
+# Contacts are reloaded as soon as the Contacts.app database changes,
+# so this is only a fallback in case a change goes unnoticed
+MAX_CACHE_AGE = 86400  # 1 day
 MIN_MATCH_SCORE = 70
 
+# Increment when the format of the contacts cache changes
+CONTACTS_VERSION = 2
+
+# Serializers for the contacts cache, fastest first (see
+# `extra/benchmark.py serializers`). The first one that's registered
+# is used.
+CONTACTS_SERIALIZERS = ('marshal', 'msgpack', 'cpickle')
+
+
+def contacts_serializer():
+    """Return name of serializer to save contacts cache with."""
+    for name in CONTACTS_SERIALIZERS:
+        if manager.serializer(name) is not None:
+            return name
+
 
 class Contacts(object):
-    """Simple database of contacts."""
+    """Simple database of contacts.
 
-    def __init__(self):
+    :param wf: workflow to cache contacts with. Defaults to
+        :func:`~workflow.current_workflow`.
+    :type wf: :class:`~workflow.Workflow`
+
+    """
+
+    def __init__(self, wf=None):
+        global log
+        self.wf = wf or current_workflow()
+        log = self.wf.logger
+        self.store = GenerationStore(self.wf, 'contacts')
         self.update()
 
     def update(self, force=False):
         """Load contacts from cache and update cached data if old."""
-        # Load cached contacts
-        self.contacts = wf.cached_data('contacts', max_age=0)
-        if self.contacts is None:
-            self.contacts = {}
+        def stale(pointer):
+            # A cache saved with another serializer is still loaded,
+            # but rebuilt with the current one
+            serializer = pointer.get('files', {}).get('contacts')
+            return (pointer.get('version') != CONTACTS_VERSION or
+                    serializer != contacts_serializer() or
+                    contacts_source().changed(pointer.get('fingerprint')))
+
+        with self.wf.span('contacts.update'):
+            cmd = ['/usr/bin/python',
+                   self.wf.workflowfile('update_contacts.py')]
+            pointer = self.wf.cached_data_swr('contacts', cmd, MAX_CACHE_AGE,
+                                              job='update-contacts',
+                                              stale_func=stale, force=force)
 
-        # Update if required
-        if not wf.cached_data_fresh('contacts', MAX_CACHE_AGE) or force:
-            log.debug('Updating contacts cache ...')
-            cmd = ['/usr/bin/python', wf.workflowfile('update_contacts.py')]
-            run_in_background('update-contacts', cmd)
+            self.contacts = {}
+            self._pointer = None
+            self._names = None
+
+            if pointer and pointer.get('version') == CONTACTS_VERSION:
+                try:
+                    self.contacts = {
+                        'contacts': self.store.load(pointer, 'contacts')}
+                except IOError as err:  # generation has been deleted
+                    log.warning('Error loading contacts : %s', err)
+                else:
+                    self._pointer = pointer
 
     @property
     def empty(self):
@@ -52,16 +99,49 @@ class Contacts(object):
     def updating(self):
         return is_running('update-contacts')
 
+    @property
+    def names(self):
+        """:class:`~nameindex.NameIndex` of loaded generation or `None`."""
+        if self._names is None and self._pointer is not None:
+            try:
+                self._names = NameIndex(
+                    self.store.path(self._pointer, 'names.idx'))
+            except (IOError, ValueError) as err:
+                log.warning('Error loading name index : %s', err)
+
+        return self._names
+
+    def is_known(self, email):
+        """Return `True` if ``email`` belongs to a contact."""
+        if self.names is None:
+            return False
+
+        return email in self.names
+
     def name_for_email(self, email):
         """Return name associated with email or `None`."""
-        key = email.lower()
-        contact = self.contacts.get('contacts', {}).get(key)
+        if self.names is None:
+            return None
+
+        name = self.names.get(email)
+        if name:
+            log.debug('%r belongs to %r', email, name)
 
-        if contact:
-            log.debug('%r belongs to %r', email, contact['name'])
-            return contact['name']
+        return name
+
+    def expand(self, contact):
+        """Return list of email addresses of ``contact``.
+
+        A group is expanded to its members' addresses, a person is
+        just their address.
+
+        """
+        members = contact.get('members')
+        if members is None:
+            return [contact['email']]
 
-        return None
+        rows = self.contacts['contacts']
+        return [rows[i]['email'] for i in members]
 
     def search(self, query):
         """Return list of dicts matching query.
@@ -74,10 +154,11 @@ class Contacts(object):
             'is_company': True/False,
         }
 
-        if `group` is True, `email` will be multiple, comma-separated emails
+        Groups have `members` instead of `email`. Use :meth:`expand`
+        to get their email addresses.
 
         """
-        hits = wf.filter(query, self.contacts['contacts'],
-                         itemgetter('key'), min_score=MIN_MATCH_SCORE)
+        hits = self.wf.filter(query, self.contacts['contacts'],
+                              itemgetter('key'), min_score=MIN_MATCH_SCORE)
 
         return hits
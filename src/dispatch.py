@@ -0,0 +1,258 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright (c) 2026 deanishe@deanishe.net
+#
+# MIT Licence. See http://opensource.org/licenses/MIT
+#
+# Created on 2026-10-19
+#
+
+"""Hand mailto: URLs to the email client.
+
+A dispatcher starts whatever opens the URLs and returns without
+waiting for it, so the workflow can exit straight away.
+
+The dispatcher is chosen with the ``MAILTO_DISPATCHER`` environment
+(i.e. workflow) variable:
+
+``open``
+    One call to ``open`` per URL. The default for `compose`.
+``batch``
+    As few calls to ``open`` as the system's limit on the length of
+    a command allows. The default for `compose-batch`.
+``capture``
+    Append URLs to the file ``MAILTO_CAPTURE_FILE`` (or do nothing if
+    it isn't set). For testing and benchmarking on machines without
+    ``open``.
+
+``open`` and ``batch`` run ``open`` in a background process (this
+script), which waits for each call and logs the ones that fail.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+from abc import ABCMeta, abstractmethod
+import os
+import subprocess
+import sys
+import tempfile
+
+from workflow import current_workflow
+
+# Bytes of the system's limit on the size of a command's arguments and
+# environment to leave unused, in case `open` adds to its environment
+ARG_MAX_HEADROOM = 4096
+
+# Bytes each argument or environment variable takes besides its text:
+# the terminating NUL and a pointer to it
+ARG_OVERHEAD = 1 + 8
+
+
+def _log():
+    return current_workflow().logger
+
+
+def _bytes(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
+def _size(arg):
+    """Return bytes ``arg`` takes in a command's arguments."""
+    return len(_bytes(arg)) + ARG_OVERHEAD
+
+
+def arg_limit():
+    """Return bytes available for the arguments of a command."""
+    try:
+        limit = os.sysconf(b'SC_ARG_MAX')
+    except (ValueError, OSError):  # not available
+        limit = 262144  # macOS's limit
+
+    env = sum(_size('{}={}'.format(k, v)) for k, v in os.environ.items())
+    return limit - env - ARG_MAX_HEADROOM
+
+
+def chunks(cmd, args, limit):
+    """Split ``args`` so that ``cmd`` + each chunk fits in ``limit`` bytes.
+
+    An argument too long to fit on its own gets a chunk to itself.
+
+    :param cmd: command the arguments are appended to
+    :type cmd: ``list``
+    :param args: arguments to split
+    :type args: ``list``
+    :param limit: maximum size of command and arguments
+    :type limit: ``int``
+    :returns: lists of arguments
+    :rtype: generator
+
+    """
+    base = sum(_size(s) for s in cmd)
+    chunk = []
+    size = base
+    for arg in args:
+        n = _size(arg)
+        if chunk and size + n > limit:
+            yield chunk
+            chunk = []
+            size = base
+        chunk.append(arg)
+        size += n
+
+    if chunk:
+        yield chunk
+
+
+class Dispatcher(object):
+    """Base class for dispatchers.
+
+    :param bundleid: bundle ID of app to open URLs in or ``None``
+        for the system default
+    :type bundleid: ``unicode``
+
+    """
+
+    __metaclass__ = ABCMeta
+
+    #: Value of ``MAILTO_DISPATCHER`` that selects this dispatcher
+    name = None
+
+    def __init__(self, bundleid=None):
+        self.bundleid = bundleid
+
+    @abstractmethod
+    def dispatch(self, urls):
+        """Open ``urls``.
+
+        :param urls: mailto: URLs
+        :type urls: ``list``
+
+        """
+
+
+class Open(Dispatcher):
+    """Call ``open`` once for each URL."""
+
+    name = 'open'
+
+    def dispatch(self, urls):
+        """Open ``urls`` with ``open`` in a background process.
+
+        The URLs are passed to the process in a temporary file, so
+        they don't count towards the limit on its arguments.
+
+        """
+        if not urls:
+            return
+
+        cmd = ['/usr/bin/python', os.path.abspath(__file__), self.name]
+        if self.bundleid:
+            cmd.append(self.bundleid)
+
+        _log().debug('Opening %d URL(s) with : %r', len(urls), cmd)
+        with tempfile.TemporaryFile() as fp, \
+                open(os.devnull, 'r+b') as devnull:
+            for url in urls:
+                fp.write(_bytes(url) + b'\0')
+            fp.seek(0)
+            subprocess.Popen(cmd, stdin=fp, stdout=devnull, stderr=devnull,
+                             close_fds=True)
+
+    def command(self):
+        """Return ``open`` command the URLs are appended to."""
+        cmd = ['open']
+        if self.bundleid:
+            cmd += ['-b', self.bundleid]
+        return cmd
+
+    def batches(self, urls):
+        """Split ``urls`` into the lists to call ``open`` with."""
+        return [[url] for url in urls]
+
+    def run(self, urls):
+        """Call ``open`` for ``urls``, waiting for each call.
+
+        Called by the background process. Failed calls are logged
+        with the output of ``open``.
+
+        """
+        log = _log()
+        cmd = self.command()
+        for batch in self.batches(urls):
+            log.debug('Running command : %r with %d URL(s)', cmd, len(batch))
+            try:
+                p = subprocess.Popen(cmd + batch, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT)
+            except OSError as err:
+                log.error('Error running %r : %s', cmd, err)
+                continue
+
+            output = p.communicate()[0]
+            if p.returncode:
+                log.error('%r failed with status %d for %d URL(s) : %s',
+                          cmd, p.returncode, len(batch),
+                          current_workflow().decode(output).strip())
+
+
+class BatchOpen(Open):
+    """Call ``open`` as few times as possible for all URLs."""
+
+    name = 'batch'
+
+    def batches(self, urls):
+        return chunks(self.command(), urls, arg_limit())
+
+
+class Capture(Dispatcher):
+    """Append URLs to ``MAILTO_CAPTURE_FILE``."""
+
+    name = 'capture'
+
+    def dispatch(self, urls):
+        path = os.getenv('MAILTO_CAPTURE_FILE')
+        if not path:
+            _log().debug('Discarding %d URL(s)', len(urls))
+            return
+
+        with open(path, 'ab') as fp:
+            for url in urls:
+                fp.write(current_workflow().decode(url).encode('utf-8') +
+                         b'\n')
+
+
+DISPATCHERS = {cls.name: cls for cls in (Open, BatchOpen, Capture)}
+
+
+def get_dispatcher(bundleid=None, default=Open.name):
+    """Return dispatcher selected by ``MAILTO_DISPATCHER``.
+
+    :param bundleid: bundle ID of app to open URLs in
+    :type bundleid: ``unicode``
+    :param default: name of dispatcher to use if ``MAILTO_DISPATCHER``
+        isn't set
+    :type default: ``unicode``
+    :returns: dispatcher
+    :rtype: :class:`Dispatcher`
+
+    """
+    name = os.getenv('MAILTO_DISPATCHER') or default
+    if name not in DISPATCHERS:
+        raise ValueError('Unknown dispatcher : {}'.format(name))
+
+    return DISPATCHERS[name](bundleid)
+
+
+def main(wf):
+    """Open URLs read from STDIN with dispatcher named in ``sys.argv``."""
+    name = wf.args[0]
+    bundleid = wf.args[1] if len(wf.args) > 1 else None
+    urls = [url for url in sys.stdin.read().split(b'\0') if url]
+    DISPATCHERS[name](bundleid).run(urls)
+
+
+if __name__ == '__main__':
+    from workflow import Workflow
+    sys.exit(Workflow().run(main))
@@ -17,33 +17,43 @@ Usage:
     mailto.py setclient <app_path>
     mailto.py toggle (format|notify_updates|help_text|cache_notify_updates)
     mailto.py compose [<recipients>]
+    mailto.py compose-batch [--open]
     mailto.py reload
+    mailto.py stats [--json]
+    mailto.py profile [--json]
     mailto.py update
     mailto.py help
 """
 
 from __future__ import print_function, unicode_literals, absolute_import
 
-from argparse import ArgumentParser
 import os
-from pipes import quote
 import re
-import shutil
-import subprocess
 import sys
 
 from workflow import Workflow3
 
-from common import run_alfred, reveal_in_finder
+from common import quote, run_alfred, reveal_in_finder
+import recipients as rcpt
 
 # Placeholder
 log = None
 
-# Very basic (and not strictly correct) email validation
+# Basic (and not strictly correct) email validation for addresses that
+# aren't in Contacts.
 # This will (wrongly) reject valid emails with no TLD, e.g.
 # dave@localhost, but my assumption is that they ain't very
-# commonly used
-email_valid = re.compile(r'[^@]+@[^@]+\.[^@]+').match
+# commonly used.
+# None of the repeated parts can match the same text in more than one
+# way, so matching takes linear time even on long, invalid input.
+email_valid = re.compile(r'''
+    [^@\s"(),:;<>\[\\\]]+       # local part
+    @
+    (?:[^\W_][\w-]*\.)+         # domain
+    (?:[^\W\d_]{2,}             # TLD
+      |[xX][nN]--[a-zA-Z0-9-]+)  # or punycode TLD
+    \Z
+''', re.UNICODE | re.VERBOSE).match
 
 # Will be opened in your browser when the help item in configuration
 # is actioned
@@ -70,6 +80,9 @@ DEFAULT_SETTINGS = {
     'cache_notify_updates': False,  # Show user when cache is updating
 }
 
+# Settings read by `search`
+SEARCH_SETTINGS = ('show_help', 'notify_updates', 'cache_notify_updates')
+
 UPDATE_SETTINGS = {
     'github_slug': 'deanishe/alfred-mailto',
     'interval': 1,  # day(s)
@@ -93,6 +106,20 @@ ICON_VERSION_OK = 'icons/update-none.icns'
 ICON_WARNING = 'icons/warning.icns'
 
 
+class SearchArgs(object):
+    """Arguments of `search`, as argparse would parse them."""
+
+    action = 'search'
+    open = False
+    json = False
+
+    def __init__(self, query=''):
+        self.query = query
+
+    def __repr__(self):
+        return 'SearchArgs(query={!r})'.format(self.query)
+
+
 # ooo        ooooo            o8o  oooo  ooooooooooooo
 # `88.       .888'            `"'  `888  8'   888   `8
 #  888b     d'888   .oooo.   oooo   888       888       .ooooo.
@@ -113,6 +140,7 @@ class MailToApp(object):
 
     def __init__(self):
         self.wf = None
+        self._search_settings = None
 
     # 88d888b. dP    dP 88d888b.
     # 88'  `88 88    88 88'  `88
@@ -134,7 +162,8 @@ class MailToApp(object):
         self._create_client_rules()
         self.args = self._parse_args()
         log.debug('args : %r', self.args)
-        method_name = 'do_{}'.format(self.args.action)
+        wf.metrics['action'] = self.args.action
+        method_name = 'do_{}'.format(self.args.action.replace('-', '_'))
         if not hasattr(self, method_name):
             raise ValueError('Invalid action : {}'.format(self.args.action))
         return getattr(self, method_name)()
@@ -155,14 +184,21 @@ class MailToApp(object):
 
         query = self.args.query
 
-        self.notify_of_update()
-        contacts = self.load_contacts()
+        with self.wf.span('notify_of_update'):
+            self.notify_of_update()
+
+        with self.wf.span('load_contacts'):
+            contacts = self.load_contacts()
+
+        self.wf.metrics['query_length'] = len(query)
+        self.wf.metrics['contacts'] = len(contacts.contacts.get('contacts',
+                                                                ()))
 
         if not query:
             subtitle = ('↩ to compose a new email or start typing to '
                         'add recipients')
 
-            if not self.wf.settings.get('show_help', True):
+            if not self.search_settings['show_help']:
                 subtitle = None
 
             self.wf.add_item('Compose a new email',
@@ -177,7 +213,7 @@ class MailToApp(object):
         if client.empty:
             title, subtitle = ('App cache not yet initialised',
                                'Try again in a few seconds…')
-            if not self.wf.settings.get('show_help', True):
+            if not self.search_settings['show_help']:
                 subtitle = None
             self.wf.add_item(title, subtitle, icon=ICON_WARNING)
             self.wf.send_feedback()
@@ -189,7 +225,9 @@ class MailToApp(object):
             return 0
 
         # Extract email addresses from query
-        query, invalid_emails, existing = self.parse_query(query)
+        with self.wf.span('parse_query'):
+            query, invalid_emails, existing = self.parse_query(query,
+                                                               contacts)
 
         # Show errors first
         if invalid_emails:
@@ -218,7 +256,7 @@ class MailToApp(object):
                 recipients = existing[:]
 
             if query:
-                if not email_valid(query):
+                if not (contacts.is_known(query) or email_valid(query)):
                     self.wf.add_item(
                         '{} is not a valid email address'.format(
                             query),
@@ -227,12 +265,12 @@ class MailToApp(object):
                 else:   # Offer to mail query and/or existing recipients
                     recipients.append(query)
 
-            recipients = ', '.join(recipients)
+            recipients = ', '.join(rcpt.unique(recipients))
             log.debug('recipients : %r', recipients)
 
             subtitle = None
 
-            if self.wf.settings.get('show_help', True):
+            if self.search_settings['show_help']:
                 subtitle = 'Hit ↩ to compose a new message'
 
             self.wf.add_item('Compose mail to {}'.format(recipients),
@@ -243,34 +281,39 @@ class MailToApp(object):
                              icon=ICON_COMPOSE)
 
         # Show results
-        for item in hits:
+        with self.wf.span('results'):
+            seen = {rcpt.address(r).lower() for r in existing}
+            for item in hits:
 
-            if item['email'] in existing:
-                log.debug('Ignoring duplicate : %r', item)
-                continue
+                emails = contacts.expand(item)
 
-            icon = ICON_PERSON
+                if all(email.lower() in seen for email in emails):
+                    log.debug('Ignoring duplicate : %r', item)
+                    continue
 
-            if item['is_group']:
-                icon = ICON_GROUP
+                icon = ICON_PERSON
 
-            elif item['is_company']:
-                icon = ICON_COMPANY
+                if item['is_group']:
+                    icon = ICON_GROUP
 
-            recipients = ', '.join(existing[:] + [item['email']])
+                elif item['is_company']:
+                    icon = ICON_COMPANY
 
-            subtitle = item['email']
+                email = ', '.join(emails)
+                recipients = ', '.join(rcpt.unique(existing + emails))
 
-            if self.wf.settings.get('show_help', True):
-                subtitle += '  //  ⇥ to add, ↩ to add & compose'
+                subtitle = email
 
-            self.wf.add_item(item['name'],
-                             subtitle,
-                             uid=item['email'],
-                             autocomplete=recipients + ', ',
-                             valid=True,
-                             arg='compose ' + quote(recipients),
-                             icon=icon)
+                if self.search_settings['show_help']:
+                    subtitle += '  //  ⇥ to add, ↩ to add & compose'
+
+                self.wf.add_item(item['name'],
+                                 subtitle,
+                                 uid=email,
+                                 autocomplete=recipients + ', ',
+                                 valid=True,
+                                 arg='compose ' + quote(recipients),
+                                 icon=icon)
 
         self.wf.send_feedback()
         return
@@ -279,15 +322,29 @@ class MailToApp(object):
     # Search helper methods
     # ------------------------------------------------------------------
 
+    @property
+    def search_settings(self):
+        """Settings used by `search`, with defaults filled in.
+
+        Looked up once per run instead of once per result.
+        """
+        if self._search_settings is None:
+            settings = self.wf.settings
+            self._search_settings = {
+                key: settings.get(key, DEFAULT_SETTINGS[key])
+                for key in SEARCH_SETTINGS}
+
+        return self._search_settings
+
     def load_contacts(self):
         """Load contacts from cache."""
         from contacts import Contacts
-        contacts = Contacts()
+        contacts = Contacts(self.wf)
         warning = None
 
         if contacts.updating:
             self.wf.rerun = 0.5
-            if self.wf.settings.get('cache_notify_updates'):
+            if self.search_settings['cache_notify_updates']:
                 self.wf.add_item('Updating contacts …', icon=ICON_RELOAD)
 
             if contacts.empty:
@@ -299,37 +356,41 @@ class MailToApp(object):
 
         if warning:
             title, subtitle = warning
-            if not self.wf.settings.get('show_help', True):
+            if not self.search_settings['show_help']:
                 subtitle = None
 
             self.wf.add_item(title, subtitle, icon=ICON_WARNING)
 
         return contacts
 
-    def parse_query(self, query):
+    def parse_query(self, query, contacts=None):
         """Extract existing valid and invalid email addresses from query.
 
+        Addresses of ``contacts`` are assumed to be valid.
+
         Return current query, invalid addresses and valid addresses.
         """
-        query = query.lower()
-        emails = []
+        emails = rcpt.split(query)
         invalid_emails = []
         existing = []
 
-        if ',' in query:
-            emails = [s.strip() for s in query.split(',')]
-
-            if len(emails):
-                existing = []
-                for email in emails[:-1]:
-
-                    if not email_valid(email):
-                        invalid_emails.append(email)
+        query = emails[-1]
+        previous = [recipient for recipient in emails[:-1] if recipient]
+        if previous:
+            # Validation results of the previous recipients are cached,
+            # as they're the same on every keystroke. The cache is only
+            # opened when needed, as that starts a session.
+            known = contacts.is_known if contacts else None
+            is_valid = rcpt.ValidationCache(self.wf, email_valid, known)
+            for recipient in previous:
+                if not is_valid(rcpt.address(recipient)):
+                    invalid_emails.append(recipient)
 
-                    else:
-                        existing.append(email)
+                else:
+                    existing.append(recipient)
 
-                query = emails[-1]
+            is_valid.save()
+            existing = rcpt.unique(existing)
 
         log.debug('existing : %r emails : %r invalid_emails : %r query : %r',
                   existing, emails, invalid_emails, query)
@@ -338,7 +399,7 @@ class MailToApp(object):
 
     def notify_of_update(self):
         """Add notification to results list if newer version available."""
-        if self.wf.settings.get('notify_updates', True):
+        if self.search_settings['notify_updates']:
             if self.wf.update_available:
                 version = wf.cached_data('__workflow_update_status',
                                          max_age=0)['version']
@@ -349,7 +410,7 @@ class MailToApp(object):
                         CONFIG_KEYWORD)
                 )
 
-                if not self.wf.settings.get('show_help', True):
+                if not self.search_settings['show_help']:
                     subtitle = None
 
                 self.wf.add_item(
@@ -371,26 +432,83 @@ class MailToApp(object):
         """Build mailto: URL and open with configured app."""
         log.debug('Composing email ...')
         from client import Client
-        from common import command_output
+        from dispatch import get_dispatcher
 
         query = self.args.query
         log.debug('Composing email to %r', query)
         client = Client(self.wf)
-        emails = [s.strip() for s in query.split(',') if s.strip()]
+        emails = rcpt.unique(s for s in rcpt.split(query) if s)
         url = client.build_url(emails)
         log.debug('URL : %r', url)
 
-        cmd = ['open']
+        app = client.default_app
+
+        log.debug('default_app : %r', app)
+
+        get_dispatcher(app['bundleid'] if app else None).dispatch([url])
+
+    def do_compose_batch(self):
+        """Build mailto: URLs for recipient lists read from STDIN.
+
+        Each line is either a comma-separated list of recipients or
+        a JSON array of recipients (i.e. JSON Lines). Blank lines are
+        ignored.
+
+        The URLs are written to STDOUT, one per line, or with `--open`
+        opened in the configured app (by default, with as few calls
+        to `open` as possible; see `dispatch.py`).
+
+        All of the input is read before any URLs are built, so nothing
+        is written or opened if a line is invalid.
+
+        """
+        from client import Client
+        from dispatch import BatchOpen, get_dispatcher
+
+        email_lists = list(self._read_recipient_lists(sys.stdin))
+        client = Client(self.wf)
+        urls = client.build_urls(email_lists)
+
+        if not self.args.open:
+            count = 0
+            for url in urls:
+                self.notify(url)
+                count += 1
+            log.debug('Built %d URL(s)', count)
+            return
+
+        urls = list(urls)
+        log.debug('Built %d URL(s)', len(urls))
 
         app = client.default_app
 
         log.debug('default_app : %r', app)
 
-        if app:
-            cmd += ['-b', app['bundleid']]
+        dispatcher = get_dispatcher(app['bundleid'] if app else None,
+                                    default=BatchOpen.name)
+        dispatcher.dispatch(urls)
 
-        cmd.append(url)
-        command_output(cmd)
+    def _read_recipient_lists(self, fp):
+        """Yield lists of recipients read from lines of ``fp``."""
+        import json
+        for i, line in enumerate(fp, 1):
+            line = self.wf.decode(line).strip()
+            if not line:
+                continue
+
+            if line.startswith('['):
+                try:
+                    emails = json.loads(line)
+                    if not all(isinstance(s, unicode) for s in emails):
+                        raise ValueError('Recipients must be strings')
+                except ValueError as err:
+                    raise ValueError('Invalid JSON on line {} : {}'.format(
+                                     i, err))
+                emails = [s.strip() for s in emails]
+            else:
+                emails = rcpt.split(line)
+
+            yield rcpt.unique(s for s in emails if s)
 
     #                dP oo   dP                        dP
     #                88      88                        88
@@ -417,12 +535,78 @@ class MailToApp(object):
         log.debug('Forcing cache update ...')
         from contacts import Contacts
         from client import Client
-        Contacts().update(force=True)
+        Contacts(self.wf).update(force=True)
         Client(self.wf).update(force=True)
         self.notify('Refreshing contacts and app caches…')
         run_alfred('{} '.format(CONFIG_KEYWORD))
         return 0
 
+    def do_stats(self):
+        """Show run-time percentiles from the workflow's metrics.
+
+        Metrics are only recorded if the ``WORKFLOW_METRICS`` workflow
+        variable is set to ``1``. With `--json`, print the percentiles
+        as JSON instead of Alfred results.
+
+        """
+        import stats
+        summary = stats.summarise(
+            stats.aggregate(stats.read_runs(self.wf.metricsfile)))
+
+        if self.args.json:
+            import json
+            self.notify(json.dumps(summary, indent=2, sort_keys=True))
+            return
+
+        if not summary['action']:
+            self.wf.add_item('No metrics recorded',
+                             'Set workflow variable WORKFLOW_METRICS '
+                             'to 1 to record them',
+                             icon=ICON_WARNING)
+
+        for key, label in stats.DIMENSIONS:
+            for row in summary[key]:
+                self.wf.add_item(
+                    '{}: {}'.format(label, row['group']),
+                    '{}  ({} runs)'.format(stats.format_row(row),
+                                           row['runs']))
+
+        self.wf.send_feedback()
+
+    def do_profile(self):
+        """Show functions that took the most time in profiled runs.
+
+        Turn profiling on with ``workflow:profile``. With `--json`,
+        print the functions as JSON instead of Alfred results.
+
+        """
+        import stats
+        paths = sorted(os.path.join(self.wf.profiledir, name)
+                       for name in os.listdir(self.wf.profiledir)
+                       if name.endswith('.pstats'))
+        rows = stats.hot_functions(paths) if paths else []
+
+        if self.args.json:
+            import json
+            self.notify(json.dumps(rows, indent=2, sort_keys=True))
+            return
+
+        if not paths:
+            self.wf.add_item('No profiles saved',
+                             'Enter "workflow:profile" to turn profiling on',
+                             icon=ICON_WARNING)
+
+        for row in rows:
+            self.wf.add_item(
+                '{} ({}:{})'.format(row['function'],
+                                    os.path.basename(row['file']),
+                                    row['line']),
+                'own {:.2f}ms  ·  total {:.2f}ms  ·  {:g} calls per run '
+                '({} runs)'.format(row['own_ms'], row['total_ms'],
+                                   row['calls'], len(paths)))
+
+        self.wf.send_feedback()
+
     #                         dP            dP
     #                         88            88
     # dP    dP 88d888b. .d888b88 .d8888b. d8888P .d8888b.
@@ -453,6 +637,7 @@ class MailToApp(object):
 
     def do_help(self):
         """Open help file in browser."""
+        import subprocess
         log.debug('Opening %r in browser ...', HELP_URL)
         subprocess.call(['open', HELP_URL])
 
@@ -940,6 +1125,7 @@ class MailToApp(object):
     def _create_client_rules(self):
         """Copy ``client_rules.json.template`` to ``datadir``."""
         if not os.path.exists(self.client_rules_path):
+            import shutil
             srcpath = self.wf.workflowfile('client_rules.json.template')
             shutil.copy(srcpath, self.client_rules_path)
             log.debug('Created empty client rules file at %r',
@@ -952,7 +1138,20 @@ class MailToApp(object):
         print(message)
 
     def _parse_args(self):
-        """Parse command-line arguments with argparse."""
+        """Parse command-line arguments.
+
+        `search` runs on every keystroke, so its arguments are parsed
+        without argparse, which is slow to import. Anything else
+        (including a query that looks like an option) goes through
+        argparse.
+
+        """
+        args = self.wf.args
+        if (args and args[0] == 'search' and len(args) <= 2 and
+                not any(arg.startswith('-') for arg in args[1:])):
+            return SearchArgs(*args[1:])
+
+        from argparse import ArgumentParser
         parser = ArgumentParser()
         parser.add_argument(
             'action',
@@ -962,10 +1161,17 @@ class MailToApp(object):
                      'setclient',
                      'toggle',
                      'compose',
+                     'compose-batch',
                      'reload',
+                     'stats',
+                     'profile',
                      'update',
                      'help'))
         parser.add_argument('query', nargs='?', default='')
+        parser.add_argument('--open', action='store_true',
+                            help='open URLs built by compose-batch')
+        parser.add_argument('--json', action='store_true',
+                            help='print stats or profile as JSON')
         return parser.parse_args(self.wf.args)
 
 
@@ -977,6 +1183,18 @@ if __name__ == '__main__':
         # libraries=[os.path.join(os.path.dirname(__file__), 'libs')],
     )
     # wf.magic_prefix = 'wf:'
+
+    def show_stats():
+        """`workflow:stats` magic argument."""
+        import stats
+        summary = stats.summarise(
+            stats.aggregate(stats.read_runs(wf.metricsfile)))
+        if not summary['action']:
+            return 'No metrics recorded'
+        return '; '.join('{}: {}'.format(row['group'], stats.format_row(row))
+                         for row in summary['action'])
+
+    wf.magic_arguments['stats'] = show_stats
     log = wf.logger
     app = MailToApp()
     sys.exit(wf.run(app.run))
@@ -0,0 +1,185 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright (c) 2026 deanishe@deanishe.net
+#
+# MIT Licence. See http://opensource.org/licenses/MIT
+#
+# Created on 2026-10-19
+#
+
+"""Compact on-disk index of email addresses to names.
+
+`compose` only needs the names of the recipients it's given, so rather
+than unpickling the whole contacts cache, it looks them up in this
+index, which is memory-mapped and read one entry at a time.
+
+The index contains every address in Contacts, including those of
+contacts without a name, so it's also used to recognise addresses that
+don't need validating.
+
+The file is a hash table. Email addresses are lowercased and hashed
+with CRC-32 into a power-of-two number of buckets. Entries are sorted
+by bucket, so each bucket is one contiguous run of entries:
+
+    header      magic, version, bucket count, entry count
+    buckets     (offset of first entry, number of entries) per bucket
+    entries     (email length, name length, flags), email, name
+
+Strings are UTF-8. A lookup is one hash and a scan of one bucket,
+which rarely holds more than two entries.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import mmap
+import struct
+from zlib import crc32
+
+MAGIC = b'MTNI'
+VERSION = 1
+
+HEADER = struct.Struct(b'<4sIII')
+BUCKET = struct.Struct(b'<II')
+ENTRY = struct.Struct(b'<HHB')
+
+# Longest email address or name an entry can hold (in UTF-8 bytes)
+MAX_LENGTH = 0xffff
+
+# Entry flags
+FLAG_COMPANY = 1  # name is a company name
+
+
+def _hash(email):
+    """Return hash of UTF-8-encoded, lowercased ``email``."""
+    return crc32(email) & 0xffffffff
+
+
+def write_index(path, entries):
+    """Write index of ``entries`` to ``path``.
+
+    :param path: where to save the index
+    :type path: ``unicode``
+    :param entries: mapping of email addresses to ``(name, flags)``.
+        Addresses that differ only in case are stored once, with the
+        name of the one that sorts first.
+    :type entries: ``dict``
+    :raises ValueError: if an address or name is longer than
+        :const:`MAX_LENGTH` bytes
+
+    """
+    records = {}
+    for email in sorted(entries):
+        key = email.lower().encode('utf-8')
+        if key in records:
+            continue
+
+        name, flags = entries[email]
+        name = name.encode('utf-8')
+        for value in (key, name):
+            if len(value) > MAX_LENGTH:
+                raise ValueError('Too long for name index ({} bytes) : '
+                                 '{!r}'.format(len(value), value[:50]))
+
+        records[key] = (name, flags)
+
+    size = 1
+    while size < len(records):
+        size *= 2
+    mask = size - 1
+
+    buckets = [[] for _ in range(size)]
+    for key in sorted(records):
+        buckets[_hash(key) & mask].append(key)
+
+    offset = HEADER.size + BUCKET.size * size
+    table = []
+    data = []
+    for keys in buckets:
+        table.append(BUCKET.pack(offset, len(keys)))
+        for key in keys:
+            name, flags = records[key]
+            entry = ENTRY.pack(len(key), len(name), flags) + key + name
+            data.append(entry)
+            offset += len(entry)
+
+    with open(path, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, VERSION, size, len(records)))
+        fp.write(b''.join(table))
+        fp.write(b''.join(data))
+
+
+class NameIndex(object):
+    """Read-only view of an index written by :func:`write_index`.
+
+    Raises :class:`IOError` if the file doesn't exist and
+    :class:`ValueError` if it isn't a valid index.
+
+    :param path: path to index file
+    :type path: ``unicode``
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            if len(self._map) < HEADER.size:
+                raise ValueError('Invalid name index : {}'.format(path))
+
+            magic, version, self.size, self.count = HEADER.unpack_from(
+                self._map)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('Invalid name index : {}'.format(path))
+        except Exception:
+            self._map.close()
+            raise
+
+        self._mask = self.size - 1
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Unmap index file."""
+        self._map.close()
+
+    def lookup(self, email):
+        """Return ``(name, flags)`` for ``email`` or ``None``."""
+        key = email.lower().encode('utf-8')
+        offset, count = BUCKET.unpack_from(
+            self._map, HEADER.size + BUCKET.size * (_hash(key) & self._mask))
+
+        for _ in range(count):
+            key_len, name_len, flags = ENTRY.unpack_from(self._map, offset)
+            offset += ENTRY.size
+            if self._map[offset:offset + key_len] == key:
+                offset += key_len
+                name = self._map[offset:offset + name_len]
+                return name.decode('utf-8'), flags
+            offset += key_len + name_len
+
+        return None
+
+    def __contains__(self, email):
+        return self.lookup(email) is not None
+
+    def get(self, email, default=None):
+        """Return name for ``email`` or ``default``.
+
+        ``default`` is also returned if the contact has no name.
+        """
+        result = self.lookup(email)
+        if result is None or not result[0]:
+            return default
+
+        return result[0]
+
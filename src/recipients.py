@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright (c) 2026 deanishe@deanishe.net
+#
+# MIT Licence. See http://opensource.org/licenses/MIT
+#
+# Created on 2026-10-19
+#
+
+"""Split and parse lists of recipients.
+
+A recipient is a bare address (``bob@example.com``) or a name and an
+angle-addr (``Bob Smith <bob@example.com>``). Names may be quoted and
+contain commas (``"Smith, Bob" <bob@example.com>``), which is how
+`Formatter` writes them, so a list can't simply be split on commas.
+
+Quotes and angle brackets don't have to be closed, as the user may
+still be typing.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import re
+
+# Pieces of a recipient list. Together, they match the whole string.
+_pieces = re.compile(r'''
+    "(?:[^"\\]|\\.)*"?      # quoted string
+    | <[^>]*>?              # angle-addr
+    | [^,"<]+               # anything else
+    | ,                     # separator
+''', re.VERBOSE).findall
+
+_unescape = re.compile(r'\\(.)').sub
+
+
+def split(text):
+    """Return list of recipients in comma-separated ``text``.
+
+    Commas in quoted names and angle-addrs don't separate recipients.
+    Recipients are stripped of surrounding whitespace, but otherwise
+    left as they are. There is always at least one (possibly empty)
+    recipient: the last one is what the user is currently typing.
+
+    """
+    if '"' not in text and '<' not in text:  # nothing to protect
+        return [s.strip() for s in text.split(',')]
+
+    recipients = []
+    current = []
+    for piece in _pieces(text):
+        if piece == ',':
+            recipients.append(''.join(current).strip())
+            current = []
+        else:
+            current.append(piece)
+
+    recipients.append(''.join(current).strip())
+    return recipients
+
+
+def parse(recipient):
+    """Return ``(name, email)`` for ``recipient``.
+
+    ``name`` is ``None`` if ``recipient`` is a bare address.
+    """
+    if '<' not in recipient:
+        return None, recipient.strip()
+
+    name = []
+    email = None
+    for piece in _pieces(recipient):
+        if piece.startswith('<'):
+            email = piece[1:].rstrip('>').strip()
+        else:
+            name.append(piece)
+
+    if email is None:
+        return None, recipient.strip()
+
+    name = ''.join(name).strip()
+    if name.startswith('"'):  # quoted name, possibly unterminated
+        if len(name) > 1 and name.endswith('"'):
+            name = name[1:-1]
+        else:
+            name = name[1:]
+        name = _unescape(r'\1', name)
+
+    return name or None, email
+
+
+def address(recipient):
+    """Return email address of ``recipient``."""
+    return parse(recipient)[1]
+
+
+def unique(recipients):
+    """Return ``recipients`` without duplicate addresses.
+
+    Addresses are compared case-insensitively. The first occurrence of
+    each address is kept, so the order of recipients is preserved.
+    """
+    seen = set()
+    result = []
+    for recipient in recipients:
+        key = address(recipient).lower()
+        if key not in seen:
+            seen.add(key)
+            result.append(recipient)
+
+    return result
+
+
+class ValidationCache(object):
+    """Remember which addresses are valid for the current session.
+
+    The recipients before the one being typed are the same on every
+    keystroke, so their validation results are kept in the session
+    cache instead of being recomputed.
+
+    :param wf: workflow whose session cache to use
+    :type wf: :class:`~workflow.Workflow3`
+    :param validate: function that returns ``True`` if an address
+        is valid
+    :type validate: ``callable``
+    :param known: function that returns ``True`` if an address is
+        known to be valid, e.g. because it belongs to a contact. Known
+        addresses are neither validated nor cached.
+    :type known: ``callable``
+
+    """
+
+    def __init__(self, wf, validate, known=None,
+                 name='recipient_validation'):
+        self.wf = wf
+        self.validate = validate
+        self.known = known
+        self.name = name
+        self.results = wf.cached_data(name, max_age=0, session=True) or {}
+        self._dirty = False
+
+    def __call__(self, email):
+        """Return ``True`` if ``email`` is valid."""
+        if self.known is not None and self.known(email):
+            return True
+
+        valid = self.results.get(email)
+        if valid is None:
+            valid = self.results[email] = bool(self.validate(email))
+            self._dirty = True
+
+        return valid
+
+    def save(self):
+        """Save new results to the session cache."""
+        if self._dirty:
+            self.wf.cache_data(self.name, self.results, session=True)
+            self._dirty = False
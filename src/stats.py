@@ -0,0 +1,210 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright (c) 2026 deanishe@deanishe.net
+#
+# MIT Licence. See http://opensource.org/licenses/MIT
+#
+# Created on 2026-10-19
+#
+
+"""Latency percentiles and profiles of workflow runs.
+
+The metrics file (see `Workflow.metrics`) has one line per run. Runs
+are grouped by action, by query length and by number of contacts, and
+their times added to a :class:`Histogram` per group. The file is read
+a line at a time, so memory use depends on the number of groups, not
+the number of runs.
+
+:func:`hot_functions` combines the profiles saved when profiling is
+turned on (see `Workflow.profiling`).
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import json
+import math
+import os
+
+PERCENTILES = (50, 95, 99)
+
+# Percentiles are accurate to within this fraction of the true value
+ACCURACY = 0.02
+
+_GAMMA = (1 + ACCURACY) / (1 - ACCURACY)
+_LOG_GAMMA = math.log(_GAMMA)
+
+# Shorter times are counted as this many milliseconds
+MIN_TIME = 0.01
+
+# Lower bounds of groups
+QUERY_LENGTH_GROUPS = (0, 1, 3, 6, 11, 21)
+CONTACTS_GROUPS = (0, 100, 1000, 10000)
+
+# Ways runs are grouped, in display order. Runs without the metric
+# (e.g. actions other than `search`) aren't in any of its groups.
+DIMENSIONS = (
+    ('action', 'Action'),
+    ('query_length', 'Query length'),
+    ('contacts', 'Contacts'),
+)
+
+
+class Histogram(object):
+    """Streaming quantile sketch with logarithmic buckets.
+
+    A time ``t`` is counted in bucket ``ceil(log(t) / log(gamma))``, so
+    every time in a bucket is within :data:`ACCURACY` of the bucket's
+    midpoint. Times from 0.01ms to an hour fit in fewer than 500
+    buckets, however many are added.
+
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+
+    def add(self, ms):
+        """Add time of ``ms`` milliseconds."""
+        key = int(math.ceil(math.log(max(ms, MIN_TIME)) / _LOG_GAMMA))
+        self.buckets[key] = self.buckets.get(key, 0) + 1
+        self.count += 1
+
+    def percentile(self, p):
+        """Return ``p``-th percentile in milliseconds or ``None``."""
+        if not self.count:
+            return None
+
+        rank = p / 100.0 * (self.count - 1)
+        seen = 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                break
+
+        return 2 * _GAMMA ** key / (_GAMMA + 1)
+
+
+def _group(value, bounds):
+    """Return name of group ``value`` is in."""
+    for i, lower in enumerate(bounds):
+        upper = bounds[i + 1] - 1 if i + 1 < len(bounds) else None
+        if upper is None:
+            return '{}+'.format(lower)
+        if value <= upper:
+            if lower == upper:
+                return '{}'.format(lower)
+            return '{}–{}'.format(lower, upper)
+
+
+def _group_key(name):
+    """Sort key for group ``name``: numeric groups by lower bound."""
+    lower = name.split('–')[0].rstrip('+')
+    if lower.isdigit():
+        return (0, int(lower))
+    return (1, name)
+
+
+def read_runs(path):
+    """Yield runs from metrics file ``path`` and its rotated backup.
+
+    Lines that aren't valid JSON (e.g. one being written) are skipped.
+    """
+    for filepath in (path + '.1', path):
+        if not os.path.exists(filepath):
+            continue
+
+        with open(filepath, 'rb') as fp:
+            for line in fp:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def aggregate(runs):
+    """Return histograms of run times grouped per :data:`DIMENSIONS`.
+
+    :param runs: metrics of runs
+    :type runs: iterable of ``dict``
+    :returns: ``{dimension: {group: Histogram}}``
+    :rtype: ``dict``
+
+    """
+    groups = {key: {} for key, _ in DIMENSIONS}
+    for run in runs:
+        ms = run.get('total')
+        if ms is None:
+            continue
+
+        names = {}
+        if run.get('action'):
+            names['action'] = run['action']
+        if 'query_length' in run:
+            names['query_length'] = _group(run['query_length'],
+                                           QUERY_LENGTH_GROUPS)
+        if 'contacts' in run:
+            names['contacts'] = _group(run['contacts'], CONTACTS_GROUPS)
+
+        for key, name in names.items():
+            if name not in groups[key]:
+                groups[key][name] = Histogram()
+            groups[key][name].add(ms)
+
+    return groups
+
+
+def summarise(groups):
+    """Return JSON-serialisable percentiles of :func:`aggregate` output.
+
+    :returns: ``{dimension: [{'group', 'runs', 'p50', ...}, ...]}``.
+        Groups are in display order.
+    :rtype: ``dict``
+
+    """
+    summary = {}
+    for key, _ in DIMENSIONS:
+        rows = []
+        for name in sorted(groups[key], key=_group_key):
+            hist = groups[key][name]
+            row = {'group': name, 'runs': hist.count}
+            for p in PERCENTILES:
+                row['p{}'.format(p)] = round(hist.percentile(p), 1)
+            rows.append(row)
+        summary[key] = rows
+
+    return summary
+
+
+def format_row(row):
+    """Return percentiles in summary ``row`` as text."""
+    return '  ·  '.join('p{0} {1:.0f}ms'.format(p, row['p{}'.format(p)])
+                        for p in PERCENTILES)
+
+
+def hot_functions(paths, limit=20):
+    """Return functions with the highest own time in profiles ``paths``.
+
+    Times and calls are averaged over the profiles.
+
+    :param paths: paths to ``.pstats`` files
+    :type paths: ``list``
+    :param limit: maximum number of functions to return
+    :type limit: ``int``
+    :returns: list of dicts with keys ``function``, ``file``, ``line``,
+        ``calls``, ``own_ms`` and ``total_ms``
+    :rtype: ``list``
+
+    """
+    import pstats
+    profile = pstats.Stats(*paths)
+    runs = float(len(paths))
+    rows = []
+    for (filename, line, function), data in profile.stats.items():
+        _, calls, own, total, _ = data
+        rows.append({'function': function, 'file': filename, 'line': line,
+                     'calls': calls / runs, 'own_ms': own * 1000 / runs,
+                     'total_ms': total * 1000 / runs})
+
+    rows.sort(key=lambda row: row['own_ms'], reverse=True)
+    return rows[:limit]
@@ -0,0 +1,208 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright (c) 2026 deanishe@deanishe.net
+#
+# MIT Licence. See http://opensource.org/licenses/MIT
+#
+# Created on 2026-10-19
+#
+
+"""Caches made of several files that are replaced as a unit.
+
+The files of a store are written to a new "generation" directory,
+``<cachedir>/<name>/gen-<N>``, which is then published by replacing
+the store's pointer. The pointer is a small, ordinary cache entry
+saved with `Workflow.cache_data()` under the store's name, so it is
+written atomically and works with the rest of the caching API. It
+contains the generation number, the files in the generation and any
+header data (e.g. the fingerprint of the data's source):
+
+{
+    'generation': 1792400645123456,
+    'files': {'contacts': 'cpickle', ...},  # file name: serializer or None
+    'fingerprint': '...',
+}
+
+Readers load the pointer once and then read files from that generation
+only, so they always see a consistent set of files without taking a
+lock. The previous few generations are kept, so readers that loaded
+an older pointer can finish reading.
+
+Generation numbers are the time of publication in microseconds (or
+one more than the newest generation on disk, if that's later), so
+they keep increasing when the cache is cleared, and data derived from
+a store can be invalidated by comparing them. Publishers hold a lock
+on the store, so concurrent publishers never pick the same number and
+publish their generations in order.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+import os
+import time
+
+from workflow import manager
+from workflow.util import LockFile, uninterruptible
+
+# How many generations to keep on disk
+KEEP_GENERATIONS = 3
+
+
+class GenerationStore(object):
+    """A set of cache files that are published together.
+
+    :param wf: workflow whose cache directory the store is in
+    :type wf: :class:`~workflow.Workflow`
+    :param name: name of the store and of its pointer
+    :type name: ``unicode``
+
+    """
+
+    def __init__(self, wf, name, keep=KEEP_GENERATIONS):
+        self.wf = wf
+        self.name = name
+        self.keep = keep
+
+    @property
+    def root(self):
+        """Directory containing the store's generations."""
+        return self.wf.cachefile(self.name)
+
+    def dirpath(self, generation):
+        """Return path of directory for ``generation``."""
+        return os.path.join(self.root, 'gen-{}'.format(generation))
+
+    def generations(self):
+        """Return sorted list of generation numbers on disk."""
+        if not os.path.exists(self.root):
+            return []
+
+        generations = []
+        for filename in os.listdir(self.root):
+            if filename.startswith('gen-'):
+                try:
+                    generations.append(int(filename[4:]))
+                except ValueError:
+                    pass
+
+        return sorted(generations)
+
+    def publish(self, files, serializer=None, writers=None, **header):
+        """Write ``files`` as a new generation and make it current.
+
+        :param files: mapping of file name to the data to save in it
+        :type files: ``dict``
+        :param serializer: name of serializer to save files with.
+            Defaults to the workflow's cache serializer.
+        :type serializer: ``unicode``
+        :param writers: mapping of file name to a function that is
+            called with the path to write the file to. Use for files
+            in their own format; read them via :meth:`path`.
+        :type writers: ``dict``
+        :param **header: additional data to save in the pointer
+        :returns: the new pointer
+        :rtype: ``dict``
+
+        """
+        serializer_name = serializer or self.wf.cache_serializer
+        if manager.serializer(serializer_name) is None:
+            raise ValueError('Unknown serializer : {}'.format(
+                             serializer_name))
+
+        with LockFile(self.root):
+            return self._write(files, serializer_name, writers or {},
+                               header)
+
+    def _write(self, files, serializer_name, writers, header):
+        """Write and publish a new generation. Called with store locked."""
+        serializer = manager.serializer(serializer_name)
+        generations = self.generations()
+        generation = int(time.time() * 1000000)
+        if generations and generations[-1] >= generation:
+            generation = generations[-1] + 1
+
+        # Write to a temporary directory that is renamed when complete,
+        # so a generation directory is never seen half-written
+        tempdir = os.path.join(self.root, '.gen-{}.{}.tmp'.format(
+                               generation, os.getpid()))
+        os.makedirs(tempdir)
+        try:
+            for filename, data in files.items():
+                path = os.path.join(tempdir, '{}.{}'.format(filename,
+                                                           serializer_name))
+                with open(path, 'wb') as fp:
+                    serializer.dump(data, fp)
+
+            for filename, write in writers.items():
+                write(os.path.join(tempdir, filename))
+
+            os.rename(tempdir, self.dirpath(generation))
+        finally:
+            if os.path.exists(tempdir):
+                import shutil
+                shutil.rmtree(tempdir)
+
+        pointer = dict(header)
+        pointer['generation'] = generation
+        pointer['files'] = {filename: serializer_name for filename in files}
+        pointer['files'].update({filename: None for filename in writers})
+        self._publish(pointer)
+
+        self.prune()
+        self.wf.logger.debug('[%s] published generation %d',
+                             self.name, generation)
+
+        return pointer
+
+    @uninterruptible
+    def _publish(self, pointer):
+        """Replace pointer."""
+        self.wf.cache_data(self.name, pointer)
+
+    def prune(self):
+        """Delete all but the newest :attr:`keep` generations."""
+        import shutil
+        for generation in self.generations()[:-self.keep]:
+            shutil.rmtree(self.dirpath(generation), ignore_errors=True)
+
+    def path(self, pointer, filename):
+        """Return path of ``filename`` in the generation ``pointer`` points to.
+
+        :param pointer: a pointer returned by :meth:`publish` or loaded
+            from the cache
+        :type pointer: ``dict``
+        :param filename: name of file
+        :type filename: ``unicode``
+        :returns: path to file
+        :rtype: ``unicode``
+
+        """
+        serializer_name = pointer['files'][filename]
+        if serializer_name is not None:
+            filename = '{}.{}'.format(filename, serializer_name)
+
+        return os.path.join(self.dirpath(pointer['generation']), filename)
+
+    def load(self, pointer, filename):
+        """Load ``filename`` from the generation ``pointer`` points to.
+
+        Raises :class:`IOError` if the generation has been deleted or
+        the file's serializer is no longer registered (e.g. because an
+        optional module has been uninstalled).
+
+        :param pointer: a pointer returned by :meth:`publish` or loaded
+            from the cache
+        :type pointer: ``dict``
+        :param filename: name of file to load
+        :type filename: ``unicode``
+        :returns: data saved in file
+
+        """
+        serializer_name = pointer['files'][filename]
+        serializer = manager.serializer(serializer_name)
+        if serializer is None:
+            raise IOError('Unknown serializer : {}'.format(serializer_name))
+
+        with open(self.path(pointer, filename), 'rb') as fp:
+            return serializer.load(fp)
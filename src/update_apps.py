@@ -8,7 +8,22 @@
 # Created on 2014-10-18
 #
 
-"""Update cache of all apps on system that can handle mailto: URIs."""
+"""Update cache of all apps on system that can handle mailto: URIs.
+
+Publishes a new generation of the `client_snapshot` store (see
+`store.py`). Its pointer contains `version` (`SNAPSHOT_VERSION`) and
+`fingerprint` (hash of application directories). The generation
+contains one file, `snapshot`:
+{
+    'apps': [
+        {'name': 'Mail', 'path': '/Applications/Mail.app',
+         'bundleid': 'com.apple.mail'},
+        ...
+    ],
+    'system_default_app': {'name': ..., 'path': ..., 'bundleid': ...},
+    'client_rules': compiled rules (see `client.compile_client_rules()`),
+}
+"""
 
 from __future__ import print_function, unicode_literals, absolute_import
 
@@ -23,7 +38,10 @@ from LaunchServices import (LSCopyApplicationURLsForURL,
                             CFURLCreateWithString)
 
 from workflow import Workflow
+from client import SNAPSHOT_VERSION, compile_client_rules
 from common import nsurl_to_path, appname, bundleid
+from store import GenerationStore
+from watcher import apps_source
 
 wf = Workflow()
 log = wf.logger
@@ -70,8 +88,18 @@ def get_system_default_handler():
 
 def main(wf):
     start_time = time()
-    wf.cache_data('system_default_app', get_system_default_handler())
-    wf.cache_data('all_apps', get_email_handlers())
+    fingerprint = apps_source().fingerprint()
+    snapshot = {'client_rules': compile_client_rules(wf)}
+    snapshot['system_default_app'] = get_system_default_handler()
+    snapshot['apps'] = get_email_handlers()
+    GenerationStore(wf, 'client_snapshot').publish(
+        {'snapshot': snapshot}, version=SNAPSHOT_VERSION,
+        fingerprint=fingerprint)
+
+    # Remove caches used by earlier versions
+    for name in ('system_default_app', 'all_apps', 'app_fingerprint'):
+        wf.cache_data(name, None)
+
     log.debug('Client application caches updated in {:0.3f} seconds'.format(
               time() - start_time))
 
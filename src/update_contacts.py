@@ -10,29 +10,42 @@
 
 """Read Contacts database and cache relevant information.
 
-Generates a JSON dict:
-{
-    'contacts': [
-        {
-            'name': "Person's or company name",  # may be empty
-            'email': 'email.address@example.com',
-            'nickname': "Contact's nickname",
-            'company': "Name of contact's company",
-            'is_group': True/False,
-            'is_company': True/False,
-            'key': nickname + name + email,
-        },
-        ...
-    ],
-    'email_name_map': {
-        'email.address@example.com': "Person's or company name",
-        ...
-    }
-}
+Publishes a new generation of the `contacts` store (see `store.py`)
+with the files:
+
+`contacts`:
+[
+    {
+        'name': "Person's or company name",  # may be empty
+        'email': 'email.address@example.com',
+        'nickname': "Contact's nickname",
+        'company': "Name of contact's company",
+        'is_group': True/False,
+        'is_company': True/False,
+        'key': nickname + name + email,
+    },
+    ...
+    {
+        'name': 'Group name',
+        'members': [index of member in this list, ...],
+        'is_group': True,
+        'is_company': False,
+        'key': name,
+    },
+    ...
+]
+
+`names.idx`:
+    Index of email addresses to names (see `nameindex.py`).
+
+The store's pointer also contains `version` (`CONTACTS_VERSION`) and
+the fingerprint of the Contacts.app database files under the key
+`fingerprint`.
 """
 
 from __future__ import print_function, unicode_literals, absolute_import
 
+import logging
 import sys
 from time import time
 
@@ -40,6 +53,11 @@ import AddressBook as AB
 
 from workflow import Workflow
 
+from contacts import CONTACTS_VERSION, contacts_serializer
+from nameindex import FLAG_COMPANY, write_index
+from store import GenerationStore
+from watcher import contacts_source
+
 
 log = None
 
@@ -70,6 +88,17 @@ def _unwrap(cdw):
     return values
 
 
+def _unicode(value):
+    """Convert string from Address Book to plain `unicode`.
+
+    PyObjC returns a subclass of `unicode`, which can't be saved with
+    the `marshal` serializer.
+    """
+    if not value:
+        return ''
+    return unicode(value)
+
+
 def _unicode_list(cdw):
     """Make a list from CoreDataWrapper"""
     return [unicode(v) for v in _unwrap(cdw)]
@@ -78,10 +107,10 @@ def _unicode_list(cdw):
 # map dict keys to AB properties and conversion funcs
 _person_text_property_map = {
     # output key :  (property, conversion func)
-    'first_name': (AB.kABFirstNameProperty, None),
-    'last_name': (AB.kABLastNameProperty, None),
-    'nickname': (AB.kABNicknameProperty, None),
-    'company': (AB.kABOrganizationProperty, None),
+    'first_name': (AB.kABFirstNameProperty, _unicode),
+    'last_name': (AB.kABLastNameProperty, _unicode),
+    'nickname': (AB.kABNicknameProperty, _unicode),
+    'company': (AB.kABOrganizationProperty, _unicode),
     'emails': (AB.kABEmailProperty, _unicode_list),
 }
 
@@ -133,7 +162,7 @@ def ab_person_to_dict(person):
 def ab_group_to_dict(group):
     """Convert ABGroup to Python dict. Return None if group is empty."""
     d = {'name': '', 'emails': [], 'is_group': True, 'is_company': False}
-    d['name'] = group.valueForProperty_(AB.kABGroupNameProperty)
+    d['name'] = _unicode(group.valueForProperty_(AB.kABGroupNameProperty))
 
     for person in group.members():
         identifier = group.distributionIdentifierForProperty_person_(
@@ -180,6 +209,9 @@ def iter_groups():
 
 def main(wf):
     start = time()
+    # Fingerprint the database before reading it, so changes made while
+    # the cache is being built trigger another update
+    fingerprint = contacts_source().fingerprint()
     # list of contact dicts:
     # [
     #     {'name': 'name of contact/company/group',
@@ -191,10 +223,16 @@ def main(wf):
     # ]
     contacts = []
     # Needed by `compose` to reconstruct the recipient
-    email_name_map = {}
+    # {email: (name, flags)}
+    names = {}
+    # Index of first row for each (lowercase) email. Used to turn
+    # group members into indices
+    row_for_email = {}
     # Just for logging stats
     people_count = 0
     group_count = 0
+    # Checked once, as there's a log message for every contact
+    debug = log.isEnabledFor(logging.DEBUG)
 
     # Load people
     seen = set()
@@ -204,10 +242,13 @@ def main(wf):
         if not len(person['emails']):
             continue
 
-        if person['name']:  # Cache names for email addresses
-            for email in person['emails']:
-                # contacts['email_name'][email] = person['name']
-                email_name_map[email] = person['name']
+        # Index all addresses, so the index also tells `search` which
+        # addresses are known to be valid. Unnamed contacts get an
+        # empty name.
+        flags = FLAG_COMPANY if person['is_company'] else 0
+        for email in person['emails']:
+            if person['name'] or email not in names:
+                names[email] = (person['name'], flags)
 
         for email in person['emails']:
             # Ignore duplicate name, email pairs
@@ -225,10 +266,13 @@ def main(wf):
             d['is_company'] = person.get('is_company', False)
             d['key'] = '{} {} {}'.format(d['nickname'], d['name'], d['email'])
 
-            msg = '{} <{}>'.format(d['name'], d['email'])
-            if d['nickname']:
-                msg += ' ({})'.format(d['nickname'])
-            log.debug(msg)
+            if debug:
+                if d['nickname']:
+                    log.debug('%s <%s> (%s)', d['name'], d['email'],
+                              d['nickname'])
+                else:
+                    log.debug('%s <%s>', d['name'], d['email'])
+            row_for_email.setdefault(email.lower(), len(contacts))
             contacts.append(d)
             people_count += 1
 
@@ -243,12 +287,28 @@ def main(wf):
         if not group:
             continue
 
-        group['email'] = ', '.join(group['emails'])
+        # Members as a list of rows, without duplicates
+        members = []
+        seen = set()
+        for email in group['emails']:
+            i = row_for_email.get(email.lower())
+            if i is None:
+                log.warning('Unknown member of group %r : %r',
+                            group['name'], email)
+                continue
+            if i not in seen:
+                seen.add(i)
+                members.append(i)
+
+        if not members:
+            continue
+
+        group['members'] = members
         group['key'] = group['name']
-        i = len(group['emails'])
         del group['emails']
 
-        log.debug('{:3d} people in "{}"'.format(i, group['name']))
+        if debug:
+            log.debug('%3d people in "%s"', len(members), group['name'])
         contacts.append(group)
         group_count += 1
 
@@ -256,12 +316,13 @@ def main(wf):
     # for key in contacts:
     #     contacts[key] = sorted(list(contacts[key]))
 
-    cache_data = {'contacts': contacts, 'email_name_map': email_name_map}
-
-    wf.cache_data('contacts', cache_data)
+    GenerationStore(wf, 'contacts').publish(
+        {'contacts': contacts}, serializer=contacts_serializer(),
+        writers={'names.idx': lambda path: write_index(path, names)},
+        version=CONTACTS_VERSION, fingerprint=fingerprint)
 
-    log.info('{} people, {} groups cached in {:0.2f} seconds'.format(
-             people_count, group_count, time() - start))
+    log.info('%d people, %d groups cached in %0.2f seconds',
+             people_count, group_count, time() - start)
 
     return 0
 
@@ -13,28 +13,123 @@
 from __future__ import print_function, unicode_literals, absolute_import
 
 import json
-from cStringIO import StringIO
+from json.decoder import errmsg
+import re
+
+# Where a comment might start
+_comment = re.compile(r'''
+    //[^\n]*                            # line comment
+  | /\*.*?\*/                           # block comment
+  | /\*                                 # unterminated comment
+''', re.DOTALL | re.VERBOSE)
+
+# The code up to the next comment (or the end of the text), and the
+# comment. Strings in the code are matched whole, so comment markers
+# inside them are left alone. Every character can be matched, so it
+# never has to backtrack over the text.
+_tokens = re.compile(r'''
+    (                                   # code
+        [^"/]*
+        (?:
+            (?: "[^"\\]*(?:\\.[^"\\]*)*"    # string
+              | "                       # unterminated string
+              | /(?![/*])               # slash that doesn't start a comment
+            )
+            [^"/]*
+        )*
+    )
+    (                                   # comment
+        //[^\n]*
+      | /\*.*?\*/
+      | /\*
+      | \Z                              # end of text
+    )
+''', re.DOTALL | re.VERBOSE)
+
+# A comment that might be in a string. If a comment marker is in a
+# string, the string ends later on the same line (JSON strings can't
+# contain newlines), so the quote that ends it is either in the comment
+# or after it on the same line. Also matches unterminated block
+# comments.
+_maybe_in_string = re.compile(r'''
+    //[^\n]*"                           # line comment containing a quote
+  | /\*                                 # block comment (all of its text,
+    (?=([^*"]*(?:\*(?!/)[^*"]*)*))\1    # so it isn't backtracked over)
+    (?: "                               # a quote in it,
+      | \Z                              # the end of the text or
+      | \*/[^\n"]*"                     # a quote later on its line
+    )
+''', re.VERBOSE)
+
+_not_newline = re.compile(r'[^\n]')
+
+
+def _blank(comment):
+    """Return whitespace in place of ``comment``, keeping newlines."""
+    if '\n' in comment:
+        return _not_newline.sub(' ', comment)
+    return ' ' * len(comment)
+
+
+def strip_comments(s):
+    """Replace ``//`` and ``/* */`` comments in ``s`` with whitespace.
+
+    Newlines are kept, so positions in the result are the same line
+    and column as in ``s``, and :mod:`json`'s error messages point
+    to the right place.
+
+    Only the text around comment markers is examined closely: if the
+    code before a marker has no backslashes and an even number of
+    quotes, the marker can't be in a string. Otherwise, the code is
+    matched string by string with ``_tokens``.
+    """
+    parts = []
+    pos = 0
+    while True:
+        match = _comment.search(s, pos)
+        if match is None:
+            break
+
+        start = match.start()
+        if s.find('\\', pos, start) != -1 or s.count('"', pos, start) % 2:
+            match = _tokens.match(s, pos)
+            start = match.start(2)
+            if start == len(s):  # no more comments
+                break
+
+        comment = s[start:match.end()]
+        if comment == '/*':
+            raise ValueError(errmsg('Unterminated comment', s, start))
+
+        parts.append(s[pos:start])
+        parts.append(_blank(comment))
+        pos = match.end()
+
+    parts.append(s[pos:])
+    return ''.join(parts)
+
+
+def loads(s, *args, **kwargs):
+    # If no comment can be in a string, each comment is replaced with
+    # a space without looking at the strings. This moves the text after
+    # comments, so if the JSON is invalid, it's parsed again with
+    # `strip_comments` to get the right position for the error message.
+    # Bytes are only decoded if they have to be: `json` decodes
+    # just the strings in them, which is quicker.
+    if kwargs.get('strict', True) and _maybe_in_string.search(s) is None:
+        space = b' ' if isinstance(s, bytes) else ' '
+        try:
+            return json.loads(_comment.sub(space, s), *args, **kwargs)
+        except ValueError:
+            pass
+
+    if isinstance(s, bytes):
+        s = s.decode('utf-8')
+    return json.loads(strip_comments(s), *args, **kwargs)
 
 
 def load(fp, *args, **kwargs):
-    real_json = []
-    in_multiline_comment = False
-    for line in fp:
-        l = line.strip()
-        if l.startswith(b'//'):
-            continue
-        if l.startswith(b'/*'):
-            in_multiline_comment = True
-            continue
-        if l.startswith(b'*/'):
-            in_multiline_comment = False
-            continue
-        if in_multiline_comment:
-            continue
-        real_json.append(line)
-
-    sio = StringIO(b'\n'.join(real_json))
-    return json.load(sio, *args, **kwargs)
+    return loads(fp.read(), *args, **kwargs)
 
 
 def dump(fp, *args, **kwargs):
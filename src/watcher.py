@@ -0,0 +1,144 @@
+#!/usr/bin/python
+# encoding: utf-8
+#
+# Copyright (c) 2026 deanishe@deanishe.net
+#
+# MIT Licence. See http://opensource.org/licenses/MIT
+#
+# Created on 2026-10-19
+#
+
+"""Detect changes to the files the caches are built from.
+
+A fingerprint of a source is built from the paths, modification times
+and sizes of its files. The fingerprint is stored in the cache when
+it is built, and the cache is only rebuilt when the fingerprint of the
+source no longer matches.
+
+Checking a fingerprint costs a handful of ``stat`` calls, so it's
+cheap enough to do on every run of the Script Filter.
+"""
+
+from __future__ import print_function, unicode_literals, absolute_import
+
+from glob import glob
+import hashlib
+import os
+from time import time
+
+# Don't report a change until the source files have been left alone
+# for this many seconds. Contacts.app writes its database in several
+# steps, so there's no point rebuilding the cache halfway through.
+DEBOUNCE = 5
+
+# Contacts.app's databases. There is one for "On My Mac" and one for
+# each account in `Sources`. The `-wal` and `-shm` files are where
+# SQLite puts recent changes.
+CONTACTS_SOURCES = [
+    '~/Library/Application Support/AddressBook/Sources',
+    '~/Library/Application Support/AddressBook/AddressBook-v22.abcddb*',
+    '~/Library/Application Support/AddressBook/Sources/*/'
+    'AddressBook-v22.abcddb*',
+]
+
+# Directories applications are installed in (the mtime of a directory
+# changes when an entry is added or removed) and the file the system
+# default mailto: handler is stored in.
+APP_SOURCES = [
+    '/Applications',
+    '/Applications/Utilities',
+    '/System/Applications',
+    '~/Applications',
+    '~/Library/Preferences/com.apple.LaunchServices/'
+    'com.apple.launchservices.secure.plist',
+]
+
+
+class Source(object):
+    """Files a cache is built from.
+
+    :param patterns: paths or glob patterns of the source files
+    :type patterns: ``list``
+    :param debounce: seconds the files must be left unchanged for
+        before a change is reported
+    :type debounce: ``int``
+
+    """
+
+    def __init__(self, patterns, debounce=DEBOUNCE):
+        self.patterns = patterns
+        self.debounce = debounce
+        self._stats = None
+
+    @property
+    def paths(self):
+        """Sorted list of existing source paths."""
+        paths = set()
+        for pattern in self.patterns:
+            pattern = os.path.expanduser(pattern)
+            if '*' in pattern:
+                paths.update(glob(pattern))
+            else:
+                paths.add(pattern)
+
+        return sorted(paths)
+
+    def stats(self):
+        """Return list of ``(path, mtime, size)`` for source files."""
+        if self._stats is None:
+            stats = []
+            for path in self.paths:
+                try:
+                    st = os.stat(path)
+                except OSError:  # doesn't exist or was just deleted
+                    continue
+                stats.append((path, st.st_mtime, st.st_size))
+
+            self._stats = stats
+
+        return self._stats
+
+    def fingerprint(self):
+        """Return hash of paths, mtimes and sizes of source files."""
+        h = hashlib.sha1()
+        for path, mtime, size in self.stats():
+            h.update('{}\0{!r}\0{}\n'.format(path, mtime, size)
+                     .encode('utf-8'))
+
+        return h.hexdigest()
+
+    def settled(self):
+        """Whether source files have been unchanged for `debounce` secs."""
+        mtimes = [mtime for _, mtime, _ in self.stats()]
+        if not mtimes:
+            return True
+
+        return time() - max(mtimes) >= self.debounce
+
+    def changed(self, fingerprint):
+        """Whether source no longer matches ``fingerprint``.
+
+        Returns ``False`` while the source is still being written to
+        (see :attr:`debounce`), so a burst of changes causes only one
+        rebuild.
+
+        :param fingerprint: fingerprint stored with the cache
+        :type fingerprint: ``unicode`` or ``None``
+        :returns: ``True`` if the cache should be rebuilt
+        :rtype: ``bool``
+
+        """
+        if self.fingerprint() == fingerprint:
+            return False
+
+        return self.settled()
+
+
+def contacts_source():
+    """Return :class:`Source` for Contacts.app's databases."""
+    return Source(CONTACTS_SOURCES)
+
+
+def apps_source():
+    """Return :class:`Source` for installed applications."""
+    return Source(APP_SOURCES)
@@ -13,7 +13,7 @@
 import os
 
 # Workflow objects
-from .workflow import Workflow, manager
+from .workflow import Workflow, current_workflow, manager
 from .workflow3 import Variables, Workflow3
 
 # Exceptions
@@ -70,6 +70,7 @@ __all__ = [
     'Variables',
     'Workflow',
     'Workflow3',
+    'current_workflow',
     'manager',
     'PasswordNotFound',
     'KeychainError',
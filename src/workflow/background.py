@@ -22,21 +22,16 @@ from __future__ import print_function, unicode_literals
 import signal
 import sys
 import os
-import subprocess
 import pickle
 
-from workflow import Workflow
+from workflow import current_workflow
+from util import LockFile
 
 __all__ = ['is_running', 'run_in_background']
 
-_wf = None
-
 
 def wf():
-    global _wf
-    if _wf is None:
-        _wf = Workflow()
-    return _wf
+    return current_workflow()
 
 
 def _log():
@@ -220,22 +215,28 @@ def run_in_background(name, args, **kwargs):
     If a process is already running under the same name, this function will
     return immediately and will not run the specified command.
 
+    The check and the launch happen under a lock on the job's PID file,
+    and the runner only returns once it has written the PID file, so
+    concurrent calls with the same ``name`` start only one job.
+
     """
-    if is_running(name):
-        _log().info('[%s] job already running', name)
-        return
+    with LockFile(_pid_file(name)):
+        if is_running(name):
+            _log().info('[%s] job already running', name)
+            return
 
-    argcache = _arg_cache(name)
+        argcache = _arg_cache(name)
 
-    # Cache arguments
-    with open(argcache, 'wb') as fp:
-        pickle.dump({'args': args, 'kwargs': kwargs}, fp)
-        _log().debug('[%s] command cached: %s', name, argcache)
+        # Cache arguments
+        with open(argcache, 'wb') as fp:
+            pickle.dump({'args': args, 'kwargs': kwargs}, fp)
+            _log().debug('[%s] command cached: %s', name, argcache)
 
-    # Call this script
-    cmd = ['/usr/bin/python', __file__, name]
-    _log().debug('[%s] passing job to background runner: %r', name, cmd)
-    retcode = subprocess.call(cmd)
+        # Call this script
+        cmd = ['/usr/bin/python', __file__, name]
+        _log().debug('[%s] passing job to background runner: %r', name, cmd)
+        import subprocess
+        retcode = subprocess.call(cmd)
 
     if retcode:  # pragma: no cover
         _log().error('[%s] background runner failed with %d', name, retcode)
@@ -279,6 +280,7 @@ def main(wf):  # pragma: no cover
         # Run the command
         log.debug('[%s] running command: %r', name, args)
 
+        import subprocess
         retcode = subprocess.call(args, **kwargs)
 
         if retcode:
@@ -36,7 +36,6 @@ import uuid
 import workflow
 
 
-_wf = None
 _log = None
 
 
@@ -65,10 +64,7 @@ def wf():
     Returns:
         workflow.Workflow: Workflow object for current workflow.
     """
-    global _wf
-    if _wf is None:
-        _wf = workflow.Workflow()
-    return _wf
+    return workflow.current_workflow()
 
 
 def log():
@@ -24,12 +24,9 @@
 from __future__ import print_function, unicode_literals
 
 import os
-import tempfile
 import re
-import subprocess
 
 import workflow
-import web
 
 # __all__ = []
 
@@ -37,15 +34,9 @@ import web
 RELEASES_BASE = 'https://api.github.com/repos/{0}/releases'
 
 
-_wf = None
-
-
 def wf():
     """Lazy `Workflow` object."""
-    global _wf
-    if _wf is None:
-        _wf = workflow.Workflow()
-    return _wf
+    return workflow.current_workflow()
 
 
 class Version(object):
@@ -206,6 +197,8 @@ def download_workflow(url):
             not filename.endswith('.alfred3workflow')):
         raise ValueError('attachment not a workflow: {0}'.format(filename))
 
+    import tempfile
+    import web
     local_path = os.path.join(tempfile.gettempdir(), filename)
 
     wf().logger.debug(
@@ -308,6 +301,7 @@ def get_valid_releases(github_slug, prereleases=False):
     wf().logger.debug('retrieving releases list: %s', api_url)
 
     def retrieve_releases():
+        import web
         wf().logger.info(
             'retrieving releases: %s', github_slug)
         return web.get(api_url).json()
@@ -388,6 +382,7 @@ def install_update():
     local_file = download_workflow(update_data['download_url'])
 
     wf().logger.info('installing updated workflow ...')
+    import subprocess
     subprocess.call(['open', local_file])
 
     update_data['available'] = False
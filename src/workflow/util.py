@@ -12,7 +12,6 @@
 
 from __future__ import print_function, absolute_import
 
-import atexit
 from collections import namedtuple
 from contextlib import contextmanager
 import errno
@@ -20,8 +19,8 @@ import fcntl
 import functools
 import os
 import signal
-import subprocess
 import sys
+import threading
 from threading import Event
 import time
 
@@ -143,6 +142,7 @@ def run_command(cmd, **kwargs):
     Returns:
         str: Output returned by ``check_output``.
     """
+    import subprocess
     cmd = [utf8ify(s) for s in cmd]
     return subprocess.check_output(cmd, **kwargs)
 
@@ -277,6 +277,12 @@ def atomic_writer(fpath, mode):
                 pass
 
 
+# Locks held by each thread of this process, so they can be re-entered.
+# Maps ``(lockfile path, PID, thread ID)`` to ``[file, shared, count]``.
+# The PID stops a forked child from thinking it holds its parent's locks.
+_held_locks = {}
+
+
 class LockFile(object):
     """Context manager to protect filepaths with lockfiles.
 
@@ -290,30 +296,55 @@ class LockFile(object):
     >>>     with open(path, 'wb') as fp:
     >>>         fp.write(data)
 
+    .. versionchanged:: 1.33
+
+    Locks are taken with :func:`fcntl.flock`. A blocked acquisition
+    waits in the kernel and wakes as soon as the lock is released,
+    instead of checking every :attr:`delay` seconds. The timeout is
+    enforced with ``SIGALRM``, which only works in the main thread;
+    other threads fall back to polling. The lockfile is left in place
+    after the lock is released, as deleting it would let another
+    process lock a new file while a third holds the old one.
+
+    A lock may be ``shared``: any number of shared locks can be held
+    at once, but not together with an exclusive one. Use a shared lock
+    to read a file that's written under an exclusive lock.
+
+    Locks are re-entrant within a thread: if the thread already holds
+    a lock on the same path (via any ``LockFile``), acquiring it again
+    succeeds at once, and the file is unlocked when the last of them is
+    released. A thread that holds a shared lock cannot also take an
+    exclusive one; :class:`AcquisitionError` is raised instead of
+    waiting for itself forever.
+
     Args:
         protected_path (unicode): File to protect with a lockfile
         timeout (float, optional): Raises an :class:`AcquisitionError`
             if lock cannot be acquired within this number of seconds.
             If ``timeout`` is 0 (the default), wait forever.
         delay (float, optional): How often to check (in seconds) if
-            lock has been released.
+            lock has been released when polling.
+        shared (bool, optional): Take a shared lock instead of an
+            exclusive one.
 
     Attributes:
         delay (float): How often to check (in seconds) whether the lock
-            can be acquired.
+            can be acquired when polling.
         lockfile (unicode): Path of the lockfile.
+        shared (bool): Whether the lock is shared.
         timeout (float): How long to wait to acquire the lock.
 
     """
 
-    def __init__(self, protected_path, timeout=0.0, delay=0.05):
+    def __init__(self, protected_path, timeout=0.0, delay=0.05,
+                 shared=False):
         """Create new :class:`LockFile` object."""
         self.lockfile = protected_path + '.lock'
-        self._lockfile = None
+        self._key = None
         self.timeout = timeout
         self.delay = delay
+        self.shared = shared
         self._lock = Event()
-        atexit.register(self.release)
 
     @property
     def locked(self):
@@ -326,65 +357,136 @@ class LockFile(object):
         If the lock is in use and ``blocking`` is ``False``, return
         ``False``.
 
-        Otherwise, check every :attr:`delay` seconds until it acquires
-        lock or exceeds attr:`timeout` and raises an :class:`AcquisitionError`.
+        Otherwise, wait until the lock is released or :attr:`timeout`
+        is exceeded, in which case raise an :class:`AcquisitionError`.
 
         """
         if self.locked and not blocking:
             return False
 
         start = time.time()
-        while True:
-
-            # Raise error if we've been waiting too long to acquire the lock
+        # Another thread is using this instance
+        while self.locked:
             if self.timeout and (time.time() - start) >= self.timeout:
-                    raise AcquisitionError('lock acquisition timed out')
+                raise AcquisitionError('lock acquisition timed out')
+            time.sleep(self.delay)
+
+        key = (os.path.abspath(self.lockfile), os.getpid(),
+               threading.current_thread().ident)
+        held = _held_locks.get(key)
+        if held is not None:  # this thread already holds the lock
+            if held[1] and not self.shared:
+                raise AcquisitionError('shared lock already held by '
+                                       'this thread')
+            held[2] += 1
+            self._key = key
+            self._lock.set()
+            return True
 
-            # If already locked, wait then try again
-            if self.locked:
-                time.sleep(self.delay)
-                continue
+        # Create in append mode so we don't lose any contents
+        fp = open(self.lockfile, 'a')
+        mode = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        try:
+            if not blocking:
+                locked = self._try_lock(fp, mode)
+            elif not self.timeout:
+                fcntl.flock(fp, mode)
+                locked = True
+            else:
+                timeout = self.timeout - (time.time() - start)
+                if isinstance(threading.current_thread(),
+                              threading._MainThread):
+                    locked = self._lock_with_alarm(fp, mode, timeout)
+                else:
+                    locked = self._lock_with_polling(fp, mode, timeout)
+        except BaseException:
+            fp.close()
+            raise
+
+        if not locked:
+            fp.close()
+            return False
 
-            # Create in append mode so we don't lose any contents
-            if self._lockfile is None:
-                self._lockfile = open(self.lockfile, 'a')
+        _held_locks[key] = [fp, self.shared, 1]
+        self._key = key
+        self._lock.set()
+        return True
 
-            # Try to acquire the lock
-            try:
-                fcntl.lockf(self._lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                self._lock.set()
-                break
-            except IOError as err:  # pragma: no cover
-                if err.errno not in (errno.EACCES, errno.EAGAIN):
-                    raise
+    def _try_lock(self, fp, mode):
+        """Lock ``fp`` if it isn't locked. Return ``True`` if locked."""
+        try:
+            fcntl.flock(fp, mode | fcntl.LOCK_NB)
+        except IOError as err:
+            if err.errno not in (errno.EACCES, errno.EAGAIN):
+                raise
+            return False
+
+        return True
 
-                # Don't try again
-                if not blocking:  # pragma: no cover
-                    return False
+    def _lock_with_alarm(self, fp, mode, timeout):
+        """Wait up to ``timeout`` seconds for lock using ``SIGALRM``."""
+        if self._try_lock(fp, mode):
+            return True
+
+        if timeout <= 0:
+            raise AcquisitionError('lock acquisition timed out')
+
+        def _timed_out(signum, frame):
+            raise AcquisitionError('lock acquisition timed out')
+
+        handler = signal.signal(signal.SIGALRM, _timed_out)
+        start = time.time()
+        # Save any timer already running, so it can be restored
+        previous, _ = signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            fcntl.flock(fp, mode)
+        except IOError as err:  # pragma: no cover
+            if err.errno != errno.EINTR:
+                raise
+            raise AcquisitionError('lock acquisition timed out')
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, handler)
+            if previous:
+                remaining = previous - (time.time() - start)
+                # A timer that should have fired already fires now
+                signal.setitimer(signal.ITIMER_REAL, max(remaining, 0.001))
+
+        return True
 
-                # Wait, then try again
-                time.sleep(self.delay)
+    def _lock_with_polling(self, fp, mode, timeout):
+        """Try to lock every :attr:`delay` seconds for ``timeout`` secs."""
+        end = time.time() + timeout
+        while not self._try_lock(fp, mode):
+            if time.time() >= end:
+                raise AcquisitionError('lock acquisition timed out')
+            time.sleep(self.delay)
 
         return True
 
     def release(self):
-        """Release the lock by deleting `self.lockfile`."""
+        """Release the lock.
+
+        The lockfile itself isn't deleted.
+        """
         if not self._lock.is_set():
             return False
 
+        held = _held_locks[self._key]
+        held[2] -= 1
         try:
-            fcntl.lockf(self._lockfile, fcntl.LOCK_UN)
+            if not held[2]:  # last holder in this thread
+                del _held_locks[self._key]
+                fcntl.flock(held[0], fcntl.LOCK_UN)
         except IOError:  # pragma: no cover
             pass
         finally:
+            if not held[2]:
+                held[0].close()
+            self._key = None
             self._lock.clear()
-            self._lockfile = None
-            try:
-                os.unlink(self.lockfile)
-            except (IOError, OSError):  # pragma: no cover
-                pass
 
-            return True
+        return True
 
     def __enter__(self):
         """Acquire lock."""
@@ -396,7 +498,7 @@ class LockFile(object):
         self.release()
 
     def __del__(self):
-        """Clear up `self.lockfile`."""
+        """Release lock."""
         self.release()  # pragma: no cover
 
 
@@ -22,18 +22,18 @@ up your Python script to best utilise the :class:`Workflow` object.
 from __future__ import print_function, unicode_literals
 
 import binascii
+from contextlib import contextmanager
 import cPickle
-from copy import deepcopy
+import errno
+import functools
 import json
 import logging
 import logging.handlers
+import marshal
 import os
 import pickle
-import plistlib
 import re
-import shutil
 import string
-import subprocess
 import sys
 import time
 import unicodedata
@@ -43,6 +43,11 @@ try:
 except ImportError:  # pragma: no cover
     import xml.etree.ElementTree as ET
 
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
 from util import (
     AcquisitionError,  # imported to maintain API
     atomic_writer,
@@ -54,6 +59,53 @@ from util import (
 #: correctly have the value ``None``)
 UNSET = object()
 
+# Per-process memo of ``os.stat`` results for cache files, shared by
+# all `Workflow` instances. Maps path to stat result or `None` if the
+# file doesn't exist. Entries are removed when a cache file is written
+# or deleted via the `Workflow` API.
+_cache_stats = {}
+
+# Directories already created/checked by `Workflow._create()`.
+# Entries are removed when a directory is cleared via the `Workflow` API.
+_created_dirs = set()
+
+# The workflow object shared by all modules in the process.
+# See `current_workflow()`.
+_current_workflow = None
+
+# Snapshot of the `info.plist` values the library uses, saved in the
+# cache directory. See `Workflow.metadata`.
+METADATA_FILE = '.metadata.json'
+
+# When the library was imported. Start-up time is measured from here.
+_import_time = time.time()
+
+#: Environment variable that turns on saving of :attr:`Workflow.metrics`
+METRICS_VAR = 'WORKFLOW_METRICS'
+
+# Size at which the metrics file is rotated
+METRICS_MAX_BYTES = 1024 * 1024
+
+#: Environment variable that turns on profiling of :meth:`Workflow.run`
+PROFILE_VAR = 'WORKFLOW_PROFILE'
+
+#: Number of profiles kept in :attr:`Workflow.profiledir`
+MAX_PROFILES = 10
+
+#: Number of log records buffered before they're written to the log file
+LOG_BUFFER_SIZE = 1000
+
+
+def _timed(name):
+    """Decorator that times a `Workflow` method with `Workflow.span()`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.span(name):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
 ####################################################################
 # Standard system icons
 ####################################################################
@@ -698,11 +750,98 @@ class PickleSerializer(object):
         return pickle.dump(obj, file_obj, protocol=-1)
 
 
+class MarshalSerializer(object):
+    """Wrapper around :mod:`marshal`.
+
+    .. versionadded:: 1.33
+
+    Faster than ``cPickle``, but only supports the built-in types
+    (``dict``, ``list``, ``tuple``, ``unicode``, ``str``, numbers,
+    ``bool`` and ``None``), not subclasses such as ``OrderedDict``.
+    Trying to save anything else raises a :class:`ValueError`. The
+    format may change between Python versions, so use it for caches,
+    not for data that must be kept.
+
+    """
+
+    @classmethod
+    def load(cls, file_obj):
+        """Load serialized object from open marshal file.
+
+        .. versionadded:: 1.33
+
+        :param file_obj: file handle
+        :type file_obj: ``file`` object
+        :returns: object loaded from marshal file
+        :rtype: object
+
+        """
+        return marshal.load(file_obj)
+
+    @classmethod
+    def dump(cls, obj, file_obj):
+        """Serialize object ``obj`` to open marshal file.
+
+        .. versionadded:: 1.33
+
+        :param obj: Python object to serialize
+        :type obj: built-in data types
+        :param file_obj: file handle
+        :type file_obj: ``file`` object
+
+        """
+        return marshal.dump(obj, file_obj, 2)
+
+
+class MsgpackSerializer(object):
+    """Wrapper around `msgpack <https://msgpack.org/>`_.
+
+    .. versionadded:: 1.33
+
+    Only registered if the ``msgpack`` package (0.5.2 or later) is
+    installed. Like JSON, it supports dicts, lists, strings, numbers,
+    ``bool`` and ``None``. Tuples are loaded as lists and ``str`` as
+    ``unicode``.
+
+    """
+
+    @classmethod
+    def load(cls, file_obj):
+        """Load serialized object from open msgpack file.
+
+        .. versionadded:: 1.33
+
+        :param file_obj: file handle
+        :type file_obj: ``file`` object
+        :returns: object loaded from msgpack file
+        :rtype: object
+
+        """
+        return msgpack.unpack(file_obj, raw=False)
+
+    @classmethod
+    def dump(cls, obj, file_obj):
+        """Serialize object ``obj`` to open msgpack file.
+
+        .. versionadded:: 1.33
+
+        :param obj: Python object to serialize
+        :type obj: msgpack-serializable data structure
+        :param file_obj: file handle
+        :type file_obj: ``file`` object
+
+        """
+        return msgpack.pack(obj, file_obj, use_bin_type=True)
+
+
 # Set up default manager and register built-in serializers
 manager = SerializerManager()
 manager.register('cpickle', CPickleSerializer)
 manager.register('pickle', PickleSerializer)
 manager.register('json', JSONSerializer)
+manager.register('marshal', MarshalSerializer)
+if msgpack is not None:  # pragma: no cover
+    manager.register('msgpack', MsgpackSerializer)
 
 
 class Item(object):
@@ -805,10 +944,15 @@ class Settings(dict):
     at ``filepath``. If the file does not exist, the dictionary
     (and settings file) will be initialised with ``defaults``.
 
+    Changes made inside a :meth:`batch` block, or while
+    :attr:`deferred` is ``True``, are saved together by :meth:`flush`.
+
     :param filepath: where to save the settings
     :type filepath: :class:`unicode`
     :param defaults: dict of default settings
     :type defaults: :class:`dict`
+    :param deferred: initial value of :attr:`deferred`
+    :type deferred: ``bool``
 
 
     An appropriate instance is provided by :class:`Workflow` instances at
@@ -816,31 +960,49 @@ class Settings(dict):
 
     """
 
-    def __init__(self, filepath, defaults=None):
+    def __init__(self, filepath, defaults=None, deferred=False):
         """Create new :class:`Settings` object."""
         super(Settings, self).__init__()
         self._filepath = filepath
         self._nosave = False
-        self._original = {}
+        self._raw = None
+        self._original_data = None
+        self._batch = 0
+        self._dirty = False
+        #: If ``True``, changes are only saved when :meth:`flush`
+        #: is called.
+        #:
+        #: .. versionadded:: 1.33
+        self.deferred = deferred
         if os.path.exists(self._filepath):
             self._load()
         elif defaults:
-            for key, val in defaults.items():
-                self[key] = val
-            self.save()  # save default settings
+            # save default settings in one go
+            super(Settings, self).update(defaults)
+            self.save()
 
     def _load(self):
-        """Load cached settings from JSON file `self._filepath`."""
-        data = {}
-        with LockFile(self._filepath, 0.5):
-            with open(self._filepath, 'rb') as fp:
-                data.update(json.load(fp))
+        """Load cached settings from JSON file `self._filepath`.
 
-        self._original = deepcopy(data)
+        No lock is needed: :meth:`save` replaces the file atomically,
+        so it's always complete.
+        """
+        with open(self._filepath, 'rb') as fp:
+            self._raw = fp.read()
 
-        self._nosave = True
-        self.update(data)
-        self._nosave = False
+        super(Settings, self).update(json.loads(self._raw))
+
+    @property
+    def _original(self):
+        """Settings as loaded from disk.
+
+        Parsed again from the file contents when first needed (i.e.
+        when a setting is changed), as that's faster than copying them
+        on every load.
+        """
+        if self._original_data is None:
+            self._original_data = json.loads(self._raw) if self._raw else {}
+        return self._original_data
 
     @uninterruptible
     def save(self):
@@ -853,6 +1015,10 @@ class Settings(dict):
         if self._nosave:
             return
 
+        if self._batch or self.deferred:
+            self._dirty = True
+            return
+
         data = {}
         data.update(self)
 
@@ -861,6 +1027,49 @@ class Settings(dict):
                 json.dump(data, fp, sort_keys=True, indent=2,
                           encoding='utf-8')
 
+        self._dirty = False
+
+    def flush(self):
+        """Save changes that are waiting to be saved.
+
+        .. versionadded:: 1.33
+
+        Does nothing if there are none.
+        """
+        if not self._dirty:
+            return
+
+        batch, deferred = self._batch, self.deferred
+        self._batch, self.deferred = 0, False
+        try:
+            self.save()
+        finally:
+            self._batch, self.deferred = batch, deferred
+
+    @contextmanager
+    def batch(self):
+        """Context manager that saves all changes made in it at once.
+
+        .. versionadded:: 1.33
+
+        >>> with wf.settings.batch():
+        >>>     wf.settings['key1'] = 'value1'
+        >>>     wf.settings['key2'] = 'value2'
+
+        Blocks may be nested: changes are saved when the outermost one
+        exits, even if it exits with an exception, as changes made
+        outside a block are saved immediately too. If :attr:`deferred`
+        is ``True``, they are saved by :meth:`flush` instead.
+
+        """
+        self._batch += 1
+        try:
+            yield self
+        finally:
+            self._batch -= 1
+            if not self._batch and not self.deferred:
+                self.flush()
+
     # dict methods
     def __setitem__(self, key, value):
         """Implement :class:`dict` interface."""
@@ -885,6 +1094,31 @@ class Settings(dict):
         return ret
 
 
+def current_workflow():
+    """Return the workflow object shared by the whole process.
+
+    .. versionadded:: 1.33
+
+    The first :class:`Workflow` (or :class:`~workflow.Workflow3`)
+    created by a process becomes its current workflow. If none has
+    been created yet, a :class:`Workflow` is created.
+
+    Helper modules should call this when they need a workflow object
+    instead of creating their own, so that ``info.plist``, the
+    settings and the logger are only loaded once per process. For
+    that to work, they must not call it at import time, before the
+    main script has created its workflow.
+
+    :returns: current workflow
+    :rtype: :class:`Workflow`
+
+    """
+    if _current_workflow is None:
+        Workflow()
+
+    return _current_workflow
+
+
 class Workflow(object):
     """The ``Workflow`` object is the main interface to Alfred-Workflow.
 
@@ -949,6 +1183,7 @@ class Workflow(object):
         self._workflowdir = None
         self._settings_path = None
         self._settings = None
+        self._defer_settings = False
         self._bundleid = None
         self._debugging = None
         self._name = None
@@ -956,6 +1191,7 @@ class Workflow(object):
         self._data_serializer = 'cpickle'
         self._info = None
         self._info_loaded = False
+        self._metadata = None
         self._logger = None
         self._items = []
         self._alfred_env = None
@@ -968,6 +1204,19 @@ class Workflow(object):
         # Magic arguments
         #: The prefix for all magic arguments. Default is ``workflow:``
         self.magic_prefix = 'workflow:'
+        #: Timings and other data about the current run. :meth:`span`
+        #: adds phase timings (in milliseconds) to ``metrics['spans']``
+        #: and :meth:`run` adds the total time and the exit status.
+        #: Workflows may add their own (JSON-serialisable) values.
+        #:
+        #: .. versionadded:: 1.33
+        self.metrics = {'spans': {}}
+        #: Whether :meth:`run` appends :attr:`metrics` to
+        #: :attr:`metricsfile`. Defaults to ``True`` if environment
+        #: variable ``WORKFLOW_METRICS`` is set to ``1``.
+        #:
+        #: .. versionadded:: 1.33
+        self.metrics_enabled = os.getenv(METRICS_VAR, '0') not in ('', '0')
         #: Mapping of available magic arguments. The built-in magic
         #: arguments are registered by default. To add your own magic arguments
         #: (or override built-ins), add a key:value pair where the key is
@@ -985,6 +1234,10 @@ class Workflow(object):
         if libraries:
             sys.path = libraries + sys.path
 
+        global _current_workflow
+        if _current_workflow is None:
+            _current_workflow = self
+
     ####################################################################
     # API methods
     ####################################################################
@@ -1087,6 +1340,28 @@ class Workflow(object):
             self._load_info_plist()
         return self._info
 
+    @property
+    def metadata(self):
+        """:class:`dict` of ``info.plist`` values used by the library.
+
+        .. versionadded:: 1.33
+
+        Contains ``bundleid``, ``name`` and ``version`` (which may be
+        ``None``). Parsing ``info.plist`` is slow, so these values are
+        saved to a small JSON file in the cache directory the first
+        time they're needed, and read from there until ``info.plist``
+        is modified.
+
+        The file isn't used if neither the cache directory nor the
+        bundle ID is set in the environment (i.e. if the workflow isn't
+        run by Alfred), as the default cache directory is named after
+        the bundle ID in ``info.plist``.
+
+        """
+        if self._metadata is None:
+            self._metadata = self._load_metadata()
+        return self._metadata
+
     @property
     def bundleid(self):
         """Workflow bundle ID from environmental vars or ``info.plist``.
@@ -1099,7 +1374,7 @@ class Workflow(object):
             if self.alfred_env.get('workflow_bundleid'):
                 self._bundleid = self.alfred_env.get('workflow_bundleid')
             else:
-                self._bundleid = unicode(self.info['bundleid'], 'utf-8')
+                self._bundleid = self.metadata['bundleid']
 
         return self._bundleid
 
@@ -1130,7 +1405,7 @@ class Workflow(object):
             if self.alfred_env.get('workflow_name'):
                 self._name = self.decode(self.alfred_env.get('workflow_name'))
             else:
-                self._name = self.decode(self.info['name'])
+                self._name = self.decode(self.metadata['name'])
 
         return self._name
 
@@ -1172,7 +1447,7 @@ class Workflow(object):
 
             # info.plist
             if not version:
-                version = self.info.get('version')
+                version = self.metadata['version']
 
             if version:
                 from update import Version
@@ -1372,6 +1647,81 @@ class Workflow(object):
         """
         return self.cachefile('%s.log' % self.bundleid)
 
+    @property
+    def metricsfile(self):
+        """Path to file :attr:`metrics` are saved to.
+
+        .. versionadded:: 1.33
+
+        The file is in the cache directory. It contains one JSON object
+        per line, one line per run, and is rotated when it reaches 1 MB.
+
+        :returns: path to metrics file within workflow's cache directory
+        :rtype: ``unicode``
+
+        """
+        return self.cachefile('%s.metrics.jsonl' % self.bundleid)
+
+    @property
+    def profiledir(self):
+        """Directory profiles of runs are saved in.
+
+        .. versionadded:: 1.33
+
+        See :attr:`profiling`.
+
+        :returns: path to ``profiles`` directory in the cache directory
+        :rtype: ``unicode``
+
+        """
+        return self._create(self.cachefile('profiles'))
+
+    @property
+    def profiling(self):
+        """Whether :meth:`run` profiles the workflow.
+
+        .. versionadded:: 1.33
+
+        Turn profiling on by setting environment variable
+        ``WORKFLOW_PROFILE`` to ``1`` or with the ``workflow:profile``
+        magic argument (and off again with ``workflow:noprofile``).
+
+        Each run is profiled with :mod:`cProfile` and the stats saved
+        to a ``.pstats`` file in :attr:`profiledir`. Only the last
+        :data:`MAX_PROFILES` are kept.
+
+        :returns: ``True`` if runs are profiled
+        :rtype: ``bool``
+
+        """
+        if os.getenv(PROFILE_VAR, '0') not in ('', '0'):
+            return True
+
+        return self.settings.get('__workflow_profile', False)
+
+    @contextmanager
+    def span(self, name):
+        """Time the enclosed block and add the time to :attr:`metrics`.
+
+        .. versionadded:: 1.33
+
+        >>> with wf.span('load_contacts'):
+        >>>     contacts = load_contacts()
+
+        Times are in milliseconds. The times of spans with the same
+        name are added together. Spans may be nested.
+
+        :param name: name of span
+        :type name: ``unicode``
+
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            spans = self.metrics['spans']
+            spans[name] = spans.get(name, 0.0) + (time.time() - start) * 1000
+
     @property
     def logger(self):
         """Logger that logs to both console and a log file.
@@ -1381,6 +1731,13 @@ class Workflow(object):
 
         Use :meth:`open_log` to open the log file in Console.
 
+        .. versionchanged:: 1.33
+
+        Records are buffered and written to the log file in batches of
+        :data:`LOG_BUFFER_SIZE`, when a record of level ``ERROR`` or
+        higher is logged, or when the process exits. Console output
+        isn't buffered.
+
         :returns: an initialised :class:`~logging.Logger`
 
         """
@@ -1405,7 +1762,9 @@ class Workflow(object):
                 maxBytes=1024 * 1024,
                 backupCount=1)
             logfile.setFormatter(fmt)
-            logger.addHandler(logfile)
+            # Flushed by `logging.shutdown()` at exit
+            logger.addHandler(logging.handlers.MemoryHandler(
+                LOG_BUFFER_SIZE, logging.ERROR, logfile))
 
             console = logging.StreamHandler()
             console.setFormatter(fmt)
@@ -1460,8 +1819,10 @@ class Workflow(object):
         """
         if not self._settings:
             self.logger.debug('reading settings from %s', self.settings_path)
-            self._settings = Settings(self.settings_path,
-                                      self._default_settings)
+            with self.span('settings'):
+                self._settings = Settings(self.settings_path,
+                                          self._default_settings,
+                                          self._defer_settings)
         return self._settings
 
     @property
@@ -1683,11 +2044,16 @@ class Workflow(object):
         cache_path = self.cachefile('%s.%s' % (name, self.cache_serializer))
         age = self.cached_data_age(name)
 
-        if (age < max_age or max_age == 0) and os.path.exists(cache_path):
-
-            with open(cache_path, 'rb') as file_obj:
-                self.logger.debug('loading cached data: %s', cache_path)
-                return serializer.load(file_obj)
+        # `age` is 0 if the file doesn't exist
+        if age and (age < max_age or max_age == 0):
+            try:
+                with open(cache_path, 'rb') as file_obj:
+                    self.logger.debug('loading cached data: %s', cache_path)
+                    return serializer.load(file_obj)
+            except IOError as err:  # deleted since it was stat'ed
+                if err.errno != errno.ENOENT:
+                    raise
+                _cache_stats.pop(cache_path, None)
 
         if not data_func:
             return None
@@ -1697,6 +2063,51 @@ class Workflow(object):
 
         return data
 
+    def cached_data_swr(self, name, cmd, max_age=60, job=None,
+                        stale_func=None, force=False):
+        """Return cached data and refresh them in the background if stale.
+
+        .. versionadded:: 1.33
+
+        A "stale-while-revalidate" version of :meth:`cached_data`. The
+        cached data are returned immediately, no matter how old they are.
+        If they are older than ``max_age`` seconds (or don't exist),
+        ``cmd`` is run via :func:`~workflow.background.run_in_background`
+        to regenerate them. ``cmd`` should save the new data with
+        :meth:`cache_data`.
+
+        Only one instance of job ``job`` runs at a time, so calling this
+        method on every run of a Script Filter starts only one refresh.
+
+        :param name: name of datastore
+        :param cmd: command to regenerate and re-cache the data. Passed
+            to :func:`~workflow.background.run_in_background`.
+        :type cmd: ``list``
+        :param max_age: maximum age of cached data in seconds
+        :type max_age: ``int``
+        :param job: name of background job. Defaults to ``name``.
+        :type job: ``unicode``
+        :param stale_func: called with the cached data (if there are any).
+            If it returns ``True``, the data are refreshed regardless
+            of their age.
+        :type stale_func: ``callable``
+        :param force: refresh data regardless of their age
+        :type force: ``Boolean``
+        :returns: cached data or ``None`` if there are none (yet)
+
+        """
+        data = self.cached_data(name, max_age=0)
+
+        if (force or not self.cached_data_fresh(name, max_age) or
+                (data is not None and stale_func and stale_func(data))):
+
+            from background import run_in_background
+
+            self.logger.debug('refreshing cache in background: %s', name)
+            run_in_background(job or name, cmd)
+
+        return data
+
     def cache_data(self, name, data):
         """Save ``data`` to cache under ``name``.
 
@@ -1712,6 +2123,8 @@ class Workflow(object):
 
         cache_path = self.cachefile('%s.%s' % (name, self.cache_serializer))
 
+        _cache_stats.pop(cache_path, None)
+
         if data is None:
             if os.path.exists(cache_path):
                 os.unlink(cache_path)
@@ -1743,6 +2156,10 @@ class Workflow(object):
     def cached_data_age(self, name):
         """Return age in seconds of cache `name` or 0 if cache doesn't exist.
 
+        Each cache file is only ``stat``-ed once per process. The
+        result is forgotten when the cache is written via
+        :meth:`cache_data` or deleted via :meth:`clear_cache`.
+
         :param name: name of datastore
         :type name: ``unicode``
         :returns: age of datastore in seconds
@@ -1751,11 +2168,19 @@ class Workflow(object):
         """
         cache_path = self.cachefile('%s.%s' % (name, self.cache_serializer))
 
-        if not os.path.exists(cache_path):
+        if cache_path not in _cache_stats:
+            try:
+                _cache_stats[cache_path] = os.stat(cache_path)
+            except OSError:
+                _cache_stats[cache_path] = None
+
+        st = _cache_stats[cache_path]
+        if st is None:
             return 0
 
-        return time.time() - os.stat(cache_path).st_mtime
+        return time.time() - st.st_mtime
 
+    @_timed('filter')
     def filter(self, query, items, key=lambda x: x, ascending=False,
                include_score=False, min_score=0, max_results=0,
                match_on=MATCH_ALL, fold_diacritics=True):
@@ -2041,8 +2466,20 @@ class Workflow(object):
         Any exceptions raised will be logged and an error message will be
         output to Alfred.
 
+        Changes to :attr:`settings` made while ``func`` runs are saved
+        together when it returns (see :attr:`Settings.deferred`). Call
+        ``wf.settings.flush()`` if another process must see them
+        sooner.
+
+        The run's :attr:`metrics` are saved if :attr:`metrics_enabled`
+        is ``True``.
+
         """
         start = time.time()
+        self.metrics['status'] = 0
+        self._defer_settings = True
+        if self._settings is not None:
+            self._settings.deferred = True
 
         # Write to debugger to ensure "real" output starts on a new line
         print('.', file=sys.stderr)
@@ -2061,16 +2498,21 @@ class Workflow(object):
             # initialise `self.settings`, which will raise an exception
             # if `settings.json` isn't valid.
             if self._update_settings:
-                self.check_update()
+                with self.span('check_update'):
+                    self.check_update()
 
             # Run workflow's entry function/method
-            func(self)
+            if self.profiling:
+                self._run_profiled(func)
+            else:
+                func(self)
 
             # Set last version run to current version after a successful
             # run
             self.set_last_version()
 
         except Exception as err:
+            self.metrics['status'] = 1
             self.logger.exception(err)
             if self.help_url:
                 self.logger.info('for assistance, see: %s', self.help_url)
@@ -2093,8 +2535,26 @@ class Workflow(object):
             return 1
 
         finally:
+            self._defer_settings = False
+            if self._settings is not None:
+                self._settings.deferred = False
+                try:
+                    self._settings.flush()
+                except Exception as err:
+                    self.logger.exception(err)
+
+            end = time.time()
+            self.metrics.update(time=start,
+                                startup=(start - _import_time) * 1000,
+                                total=(end - start) * 1000)
+            if self.metrics_enabled:
+                try:
+                    self._save_metrics()
+                except Exception as err:
+                    self.logger.exception(err)
+
             self.logger.debug('---------- finished in %0.3fs ----------',
-                              time.time() - start)
+                              end - start)
 
         return 0
 
@@ -2167,6 +2627,7 @@ class Workflow(object):
         self._items.append(item)
         return item
 
+    @_timed('send_feedback')
     def send_feedback(self):
         """Print stored items to console/Alfred as XML."""
         root = ET.Element('items')
@@ -2261,10 +2722,14 @@ class Workflow(object):
         :returns: ``True`` if an update is available, else ``False``
 
         """
-        # Create a new workflow object to ensure standard serialiser
-        # is used (update.py is called without the user's settings)
-        update_data = Workflow().cached_data('__workflow_update_status',
-                                             max_age=0)
+        # Use a new workflow object if necessary to ensure standard
+        # serialiser is used (update.py is called without the user's
+        # settings)
+        wf = self
+        if self.cache_serializer != 'cpickle':
+            wf = Workflow()
+
+        update_data = wf.cached_data('__workflow_update_status', max_age=0)
 
         self.logger.debug('update_data: %r', update_data)
 
@@ -2560,6 +3025,18 @@ class Workflow(object):
         self.magic_arguments['noprereleases'] = prereleases_off
         self.magic_arguments['update'] = do_update
 
+        # Profiling
+        def profile_on():
+            self.settings['__workflow_profile'] = True
+            return 'Profiling turned on'
+
+        def profile_off():
+            self.settings['__workflow_profile'] = False
+            return 'Profiling turned off'
+
+        self.magic_arguments['profile'] = profile_on
+        self.magic_arguments['noprofile'] = profile_off
+
         # Help
         def do_help():
             if self.help_url:
@@ -2603,6 +3080,7 @@ class Workflow(object):
             By default, *all* files will be deleted.
         :type filter_func: ``callable``
         """
+        _cache_stats.clear()
         self._delete_directory_contents(self.cachedir, filter_func)
 
     def clear_data(self, filter_func=lambda f: True):
@@ -2619,6 +3097,8 @@ class Workflow(object):
 
     def clear_settings(self):
         """Delete workflow's :attr:`settings_path`."""
+        # Drop loaded settings, so unsaved changes aren't written back
+        self._settings = None
         if os.path.exists(self.settings_path):
             os.unlink(self.settings_path)
             self.logger.debug('deleted : %r', self.settings_path)
@@ -2636,27 +3116,33 @@ class Workflow(object):
 
     def open_log(self):
         """Open :attr:`logfile` in default app (usually Console.app)."""
+        import subprocess
         subprocess.call(['open', self.logfile])
 
     def open_cachedir(self):
         """Open the workflow's :attr:`cachedir` in Finder."""
+        import subprocess
         subprocess.call(['open', self.cachedir])
 
     def open_datadir(self):
         """Open the workflow's :attr:`datadir` in Finder."""
+        import subprocess
         subprocess.call(['open', self.datadir])
 
     def open_workflowdir(self):
         """Open the workflow's :attr:`workflowdir` in Finder."""
+        import subprocess
         subprocess.call(['open', self.workflowdir])
 
     def open_terminal(self):
         """Open a Terminal window at workflow's :attr:`workflowdir`."""
+        import subprocess
         subprocess.call(['open', '-a', 'Terminal',
                         self.workflowdir])
 
     def open_help(self):
         """Open :attr:`help_url` in default browser."""
+        import subprocess
         subprocess.call(['open', self.help_url])
 
         return 'Opening workflow help URL in browser'
@@ -2755,17 +3241,109 @@ class Workflow(object):
                     continue
                 path = os.path.join(dirpath, filename)
                 if os.path.isdir(path):
+                    import shutil
                     shutil.rmtree(path)
                 else:
                     os.unlink(path)
                 self.logger.debug('deleted : %r', path)
 
+        # The directory and the ones in it may have been deleted, so
+        # `_create()` must check them again
+        prefix = os.path.join(dirpath, '')
+        for path in list(_created_dirs):
+            if path == dirpath or path.startswith(prefix):
+                _created_dirs.discard(path)
+
     def _load_info_plist(self):
         """Load workflow info from ``info.plist``."""
+        import plistlib
         # info.plist should be in the directory above this one
         self._info = plistlib.readPlist(self.workflowfile('info.plist'))
         self._info_loaded = True
 
+    def _run_profiled(self, func):
+        """Call ``func`` with a profiler and save its stats.
+
+        The stats are saved even if ``func`` fails or exits.
+        """
+        import cProfile
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(func, self)
+        finally:
+            path = os.path.join(self.profiledir, '{0:.0f}-{1}.pstats'.format(
+                                time.time() * 1000, os.getpid()))
+            profiler.dump_stats(path)
+            self.logger.debug('saved profile to %r', path)
+
+            # Delete oldest profiles
+            names = sorted(n for n in os.listdir(self.profiledir)
+                           if n.endswith('.pstats'))
+            for name in names[:-MAX_PROFILES]:
+                os.unlink(os.path.join(self.profiledir, name))
+
+    def _save_metrics(self):
+        """Append :attr:`metrics` to :attr:`metricsfile`.
+
+        The file is rotated first if it's too big.
+        """
+        path = self.metricsfile
+        try:
+            if os.path.getsize(path) >= METRICS_MAX_BYTES:
+                os.rename(path, path + '.1')
+        except OSError:  # file doesn't exist
+            pass
+
+        line = json.dumps(self.metrics, sort_keys=True, separators=(',', ':'))
+        with open(path, 'ab') as fp:
+            fp.write(line.encode('utf-8') + b'\n')
+
+    def _load_metadata(self):
+        """Load metadata snapshot, re-creating it if it's stale.
+
+        The snapshot is valid if it was made from the current
+        ``info.plist``, i.e. if the paths and modification times match.
+
+        """
+        info_path = self.workflowfile('info.plist')
+        mtime = os.stat(info_path).st_mtime
+        path = None
+        if (self.alfred_env.get('workflow_cache') or
+                self.alfred_env.get('workflow_bundleid')):
+            path = self.cachefile(METADATA_FILE)
+            try:
+                with open(path, 'rb') as fp:
+                    metadata = json.load(fp)
+                if (metadata.get('info_path') == info_path and
+                        metadata.get('info_mtime') == mtime):
+                    return metadata
+            except (IOError, ValueError):
+                pass
+
+        def _unicode(s):
+            if isinstance(s, str):
+                s = unicode(s, 'utf-8')
+            return s
+
+        metadata = {
+            'info_path': info_path,
+            'info_mtime': mtime,
+            'bundleid': _unicode(self.info['bundleid']),
+            'name': _unicode(self.info['name']),
+            'version': _unicode(self.info.get('version')),
+        }
+
+        # The logger can't be used here, as its location depends on
+        # the bundle ID
+        if path is not None:
+            try:
+                with atomic_writer(path, 'wb') as fp:
+                    json.dump(metadata, fp)
+            except (IOError, OSError):
+                pass
+
+        return metadata
+
     def _create(self, dirpath):
         """Create directory `dirpath` if it doesn't exist.
 
@@ -2775,8 +3353,10 @@ class Workflow(object):
         :rtype: ``unicode``
 
         """
-        if not os.path.exists(dirpath):
-            os.makedirs(dirpath)
+        if dirpath not in _created_dirs:
+            if not os.path.exists(dirpath):
+                os.makedirs(dirpath)
+            _created_dirs.add(dirpath)
         return dirpath
 
     def _call_security(self, action, service, account, *args):
@@ -2803,6 +3383,7 @@ class Workflow(object):
         :rtype: `tuple` (`int`, ``unicode``)
 
         """
+        import subprocess
         cmd = ['security', action, '-s', service, '-a', account] + list(args)
         p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
                              stderr=subprocess.STDOUT)
@@ -29,7 +29,7 @@ import json
 import os
 import sys
 
-from .workflow import ICON_WARNING, Workflow
+from .workflow import ICON_WARNING, Workflow, _timed
 
 
 class Variables(dict):
@@ -471,6 +471,7 @@ class Workflow3(Workflow):
         self._rerun = 0
         # Get session ID from environment if present
         self._session_id = os.getenv('_WF_SESSION_ID') or None
+        self._new_session = False
         if self._session_id:
             self.setvar('_WF_SESSION_ID', self._session_id)
 
@@ -514,10 +515,15 @@ class Workflow3(Workflow):
         It expires when the user runs a different workflow or closes
         Alfred.
 
+        If a new session was started, :meth:`run` deletes data cached by
+        earlier sessions when your workflow has finished (see
+        :meth:`clear_session_cache`).
+
         """
         if not self._session_id:
             from uuid import uuid4
             self._session_id = uuid4().hex
+            self._new_session = True
             self.setvar('_WF_SESSION_ID', self._session_id)
 
         return self._session_id
@@ -640,6 +646,57 @@ class Workflow3(Workflow):
 
         return super(Workflow3, self).cached_data(name, data_func, max_age)
 
+    def cached_data_swr(self, name, cmd, max_age=60, job=None,
+                        stale_func=None, force=False, session=False):
+        """Stale-while-revalidate cache API with session-scoped expiry.
+
+        .. versionadded:: 1.33
+
+        Args:
+            name (str): Cache key
+            cmd (list): Command that regenerates and re-caches the data.
+                It is run in the background if the cache has expired
+                or doesn't exist.
+            max_age (int): Maximum allowable age of cache in seconds.
+            job (str, optional): Name of background job. Defaults
+                to ``name``.
+            stale_func (callable, optional): Called with the cached
+                data. Return ``True`` to refresh them regardless of age.
+            force (bool, optional): Refresh data regardless of age.
+            session (bool, optional): Whether to scope the cache
+                to the current session.
+
+        See the :meth:`~workflow.Workflow.cached_data_swr` method on
+        :class:`~workflow.Workflow` for details.
+
+        If ``session`` is ``True``, then ``name`` is prefixed
+        with :attr:`session_id`.
+
+        """
+        if session:
+            name = self._mk_session_name(name)
+
+        return super(Workflow3, self).cached_data_swr(name, cmd, max_age,
+                                                      job, stale_func, force)
+
+    def run(self, func, text_errors=False):
+        """Call ``func`` to run your workflow.
+
+        See :meth:`~workflow.Workflow.run` for details.
+
+        If ``func`` started a new session (see :attr:`session_id`),
+        data cached by earlier sessions is then deleted.
+
+        """
+        retcode = super(Workflow3, self).run(func, text_errors)
+        if self._new_session:
+            try:
+                self.clear_session_cache()
+            except Exception as err:
+                self.logger.exception(err)
+
+        return retcode
+
     def clear_session_cache(self, current=False):
         """Remove session data from the cache.
 
@@ -706,6 +763,7 @@ class Workflow3(Workflow):
         icon = icon or ICON_WARNING
         return self.add_item(title, subtitle, icon=icon)
 
+    @_timed('send_feedback')
     def send_feedback(self):
         """Print stored items to console/Alfred as JSON."""
         json.dump(self.obj, sys.stdout)